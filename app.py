@@ -1,37 +1,66 @@
-from flask import Flask, render_template, request, redirect
-import psycopg2
+from flask import Flask, request, redirect, jsonify, session, Response, stream_with_context
+import json
 import os
-import pickle
 import pandas as pd
 from datetime import datetime
 import time
-from service import RecommenderService
 from base_model import CollaborativeFilteringModel, ContentBasedModel
-from annoy import AnnoyIndex
+from db import get_db_connection
+from service import RecommenderService
+from rankings import HomepageRankings
+from cold_start import DemographicRecommender
+from search_index import TitleSearchIndex
+import batch_recommendations
+import model_store
+from retraining import ModelReloader, RetrainingScheduler
+from write_buffer import WriteBuffer
+from ratings_feed import RatingsFeed
+import instrumentation
+from instrumentation import model_load_timer, render_template
+
+MAX_BATCH_USERS = 10000
+MAX_BATCH_N = 100
+MAX_AUTOCOMPLETE_LIMIT = 50
 
 app = Flask(__name__)
+# id користувача і пошуковий запит зберігаються в сесії клієнта, тому ключ має бути однаковим у всіх воркерах
+app.secret_key = os.environ.get('RECSYS_SECRET_KEY')
+if not app.secret_key:
+    # запасний ключ - лише для розробки (python app.py або RECSYS_DEV=1): з відомим ключем сесію можна підробити
+    if __name__ != '__main__' and os.environ.get('RECSYS_DEV') != '1':
+        raise RuntimeError('RECSYS_SECRET_KEY is not set')
+    app.secret_key = 'recsys-dev-secret'
+instrumentation.init_app(app)
 
-service = RecommenderService()
+service = RecommenderService(get_connection=get_db_connection)
 
 models_path = 'models'
 if not os.path.exists(models_path):
     os.makedirs(models_path)
-if 'collaborative_filtering.pickle' in os.listdir(models_path):
+# моделі завантажуються з артефактів model_store: маніфест + memory-mapped масиви; воркери, створені fork
+# після завантаження (gunicorn.conf.py), ділять одну фізичну копію масивів моделей. Без lazy, бо
+# перенавчена версія замінює файли артефакту (retraining.py)
+if model_store.exists('collaborative_filtering'):
     print('collaborative_filtering model exists')
-    service.cf_model = pickle.load(open(models_path + '/collaborative_filtering.pickle', 'rb'))
+elif 'collaborative_filtering.pickle' in os.listdir(models_path):
+    print('collaborative_filtering pickled model exists, converting')
+    batch_recommendations.load_pickled_model('collaborative_filtering', models_path).save_model()
 else:
     print('collaborative_filtering training model')
     rating_df = pd.read_csv('data/raw/100k/rating.csv')
     rating_df.drop(['Unnamed: 0'], axis=1, inplace=True)
-    service.cf_model = CollaborativeFilteringModel()
-    service.cf_model.fit(rating_df)
-    service.cf_model.save_model()
-
-if 'content_based.pickle' in os.listdir(models_path):
+    cf_model = CollaborativeFilteringModel()
+    with model_load_timer('collaborative_filtering', 'fit'):
+        cf_model.fit(rating_df)
+    cf_model.save_model()
+with model_load_timer('collaborative_filtering', 'load'):
+    service.cf_model = model_store.load('collaborative_filtering', lazy=False)
+
+if model_store.exists('content_based'):
     print('content_based model exists')
-    service.cb_model = pickle.load(open(models_path + '/content_based.pickle', 'rb'))
-    service.cb_model.index = AnnoyIndex(20, 'angular')
-    service.cb_model.index.load(f'models/{service.cb_model.model_name}_index.ann')
+elif 'content_based.pickle' in os.listdir(models_path):
+    print('content_based pickled model exists, converting')
+    batch_recommendations.load_pickled_model('content_based', models_path).save_model()
 else:
     print('content_based training model')
     rating_df = pd.read_csv('data/raw/100k/rating.csv')
@@ -42,71 +71,132 @@ else:
     movies_df.drop([266], axis=0, inplace=True)
     movies_df.drop(['Unnamed: 0'], axis=1, inplace=True)
 
-    service.cb_model = ContentBasedModel()
-    service.cb_model.fit(movies_df, rating_df)
-    service.cb_model.save_model()
+    cb_model = ContentBasedModel()
+    with model_load_timer('content_based', 'fit'):
+        cb_model.fit(movies_df, rating_df)
+    cb_model.save_model()
+with model_load_timer('content_based', 'load'):
+    service.cb_model = model_store.load('content_based', lazy=False)
+
+for model_name in ('collaborative_filtering', 'content_based'):
+    try:
+        stale_reasons = model_store.stale_reasons(model_name, get_connection=get_db_connection)
+    except Exception as e:
+        stale_reasons = [f'staleness check failed: {e}']
+    instrumentation.model_stale(model_name, bool(stale_reasons))
+    for reason in stale_reasons:
+        print(f'{model_name} model is stale: {reason}')
+
+service.precomputed = batch_recommendations.load_all(
+    ['collaborative_filtering', 'content_based'], get_db_connection,
+    model_versions={model.model_name: model_store.loaded_version(model) for model in service.models().values()})
+
+rankings = HomepageRankings(get_db_connection)
+service.fallback = DemographicRecommender(get_db_connection)
+search_index = TitleSearchIndex(get_db_connection)
+model_reloader = ModelReloader(service, get_db_connection)
+write_buffer = WriteBuffer(get_db_connection)
+retraining_scheduler = RetrainingScheduler(get_db_connection, ['collaborative_filtering', 'content_based'])
+
+
+def rating_received(user, item_id, rating, timestamp):
+    # оцінка, поставлена через цей воркер або прочитана ratings_feed з БД після запису іншим воркером
+    if service.cf_model.can_update(user, item_id):
+        service.cf_model.update(user, item_id, rating)
+    service.invalidate(user)
+    rankings.rating_added()
+    service.fallback.rating_added(user, item_id, rating, timestamp)
+
+
+ratings_feed = RatingsFeed(get_db_connection, rating_received)
+
+
+def current_user():
+    return session.get('uid')
+
+
+def start_worker():
+    # потоки не переживають fork: з кількома воркерами викликається в кожному з них після fork
+    rankings.start()
+    search_index.start()
+    service.fallback.start()
+    model_reloader.start()
+    retraining_scheduler.start()
+    write_buffer.start()
+    ratings_feed.start()
+
+
+def stop_worker():
+    write_buffer.flush()
+
+
+if os.environ.get('RECSYS_PRELOAD') != '1':
+    start_worker()
+
+
+def with_pending_ratings(user, rated_films):
+    # оцінки з буфера цього воркера, ще не записані в БД, - першими, як найновіші;
+    # рядок, який уже встиг потрапити в БД під час запису буфера, показується один раз
+    ratings = sorted(write_buffer.pending_ratings(user), key=lambda row: row[2], reverse=True)
+    if not ratings:
+        return rated_films
+    movies_info = service.movies_info([item_id for item_id, _, _ in ratings]).set_index('item_id')
+    pending = []
+    for item_id, rating, timestamp in ratings:
+        title, release_date, imdb_url, poster_url = movies_info.loc[item_id].tolist() \
+            if item_id in movies_info.index else [None] * 4
+        pending.append((item_id, title, release_date, imdb_url, poster_url, rating, timestamp))
+    written = {(item_id, rating, timestamp) for item_id, rating, timestamp in ratings}
+    return pending + [row for row in rated_films if (row[0], row[5], row[6]) not in written]
+
 
+def with_pending_wishlist(user, wishlist_films):
+    # незаписані зміни списку бажань з буфера цього воркера: додані фільми - першими,
+    # видалені й додані наново фільми з БД не показуються
+    changes = write_buffer.pending_wishlist(user)
+    if not changes:
+        return wishlist_films
+    added = [row for _, row in list(changes.values())[::-1] if row is not None]
+    movies_info = service.movies_info([row[1] for row in added]).set_index('item_id')
+    pending = [(item_id, *movies_info.loc[item_id, ['title', 'release_date', 'imdb_url']].tolist(), added_on)
+               for _, item_id, added_on, _ in added if item_id in movies_info.index]
+    return pending + [row for row in wishlist_films if row[0] not in changes]
 
-def get_db_connection():
-    conn = psycopg2.connect(host='localhost',
-                            database='RecSys',
-                            user='postgres',
-                            password='087539')
-    return conn
+
+def add_rating(item_id, rating, timestamp):
+    write_buffer.add_rating(current_user(), int(item_id), rating, timestamp)
+    ratings_feed.mark_seen(current_user(), int(item_id), timestamp)
+    rating_received(current_user(), int(item_id), rating, timestamp)
 
 
 @app.route('/', methods=['POST', 'GET'])
 def index():
     if request.method == 'GET':
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "select full_movies.item_id, full_movies.title, full_movies.release_date, full_movies.imdb_url_new, full_movies.poster_url, count(ratings.user_id) as number_of_ratings from full_movies inner join ratings on (full_movies.item_id=ratings.item_id) group by 1, 2, 3, 4, 5 order by 6 desc limit 10")
-        most_popular_movies = cur.fetchall()
-        cur.execute(
-            "select full_movies.item_id, full_movies.title,	full_movies.release_date, full_movies.imdb_url_new, avg(ratings.rating) as avg_rating from full_movies inner join ratings on (full_movies.item_id=ratings.item_id) group by 1, 2, 3, 4 having count(ratings.user_id) >= 20 order by 5 desc limit 10")
-        most_rated_movies = cur.fetchall()
-        cur.close()
-        conn.close()
+        most_popular_movies, most_rated_movies = rankings.snapshot(10)
         return render_template("unloged_main_page.html", most_popular_movies=most_popular_movies,
                                most_rated_movies=most_rated_movies)
     else:
         if request.form['btn'] == 'Search':
-            service.keyword = request.form['search_movie']
+            session['keyword'] = request.form['search_movie']
             return redirect('/unloged_search_result')
 
 
 @app.route('/main', methods=['POST', 'GET'])
 def main():
     if request.method == 'GET':
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "select full_movies.item_id, full_movies.title, full_movies.release_date, full_movies.imdb_url_new, count(ratings.user_id) as number_of_ratings from full_movies inner join ratings on (full_movies.item_id=ratings.item_id) group by 1, 2, 3, 4 order by 5 desc limit 12")
-        most_popular_movies = cur.fetchall()
-        cur.execute(
-            "select full_movies.item_id, full_movies.title,	full_movies.release_date, full_movies.imdb_url_new, avg(ratings.rating) as avg_rating from full_movies inner join ratings on (full_movies.item_id=ratings.item_id) group by 1, 2, 3, 4 having count(ratings.user_id) >= 20 order by 5 desc limit 12")
-        most_rated_movies = cur.fetchall()
-        cur.close()
-        conn.close()
-        return render_template("loged_main_page.html", user_id=service.uid, most_popular_movies=most_popular_movies,
+        most_popular_movies, most_rated_movies = rankings.snapshot(12)
+        return render_template("loged_main_page.html", user_id=current_user(), most_popular_movies=most_popular_movies,
                                most_rated_movies=most_rated_movies)
     elif request.method == 'POST':
         if request.form['btn'] == 'Add to wishlist':
             item_id = request.form['id']
             print(item_id)
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute(
-                f'INSERT INTO wishlist (user_id, item_id, datetime, from_recommendations) VALUES ({service.uid}, {item_id}, current_date, TRUE )')
-            conn.commit()
-            count = cur.rowcount
-            print(count, "Record inserted successfully into wishlist table")
-            cur.close()
-            conn.close()
+            write_buffer.add_to_wishlist(current_user(), int(item_id), True)
+            service.invalidate(current_user())
+            print("Record queued for wishlist table")
             return redirect(request.url)
         elif request.form['btn'] == 'Search':
-            service.keyword = request.form['search_movie']
+            session['keyword'] = request.form['search_movie']
             return redirect('/search_result')
         elif request.form['btn'] == 'Rate':
             print('Film is rated')
@@ -116,37 +206,28 @@ def main():
             print('rated was item with id: ', item_id)
             timestamp = int(time.mktime(datetime.now().timetuple()))
             print('rated timestamp: ', timestamp)
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute(
-                f'INSERT INTO ratings (user_id, item_id, rating, timestamp) VALUES ({service.uid}, {item_id}, {rating}, {timestamp} )')
-            conn.commit()
-            count = cur.rowcount
-            print(count, "record inserted successfully into rating table")
-            cur.close()
-            conn.close()
+            add_rating(item_id, rating, timestamp)
+            print("record queued for rating table")
             return redirect(request.url)
 
 
 @app.route('/login', methods=['POST', 'GET'])
 def login():
     if request.method == 'POST':
-        service.uid = int(request.form["id"])
-        conn = get_db_connection()
-        cur = conn.cursor()
-        sql_query = f"SELECT * FROM users where user_id={service.uid}"
-        cur.execute(sql_query)
-        result = cur.fetchall()
-        num_users = len(result)
+        session['uid'] = int(request.form["id"])
+        with get_db_connection() as conn:
+            cur = conn.cursor()
+            sql_query = f"SELECT * FROM users where user_id={current_user()}"
+            cur.execute(sql_query)
+            result = cur.fetchall()
+            num_users = len(result)
+            cur.close()
 
         if num_users == 0:
             return redirect('/signup')
         else:
             return redirect('/main')
 
-        cur.close()
-        conn.close()
-
     elif request.method == 'GET':
         return render_template("login.html")
 
@@ -155,14 +236,13 @@ def login():
 def signup():
     if request.method == 'GET':
         print('You open page')
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM users order by user_id desc limit 1")
-        max_id_user = cur.fetchall()
-        service.uid = max_id_user[0][0] + 1
-        cur.close()
-        conn.close()
-        return render_template("signup.html", new_id=service.uid)
+        with get_db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT * FROM users order by user_id desc limit 1")
+            max_id_user = cur.fetchall()
+            session['uid'] = max_id_user[0][0] + 1
+            cur.close()
+        return render_template("signup.html", new_id=current_user())
     elif request.method == 'POST':
         print('You send form')
         age = int(request.form['age'])
@@ -174,16 +254,15 @@ def signup():
         zip_code = request.form.get('zip_code')
         print(zip_code)
 
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM users order by user_id desc limit 1")
-        max_id_user = cur.fetchall()
-        service.uid = max_id_user[0][0] + 1
-        cur.execute(
-            f"INSERT INTO users (user_id, age, gender, occupation, zip_code) VALUES ({service.uid}, {age}, '{sex}', '{occupation}', '{zip_code}')")
-        conn.commit()
-        cur.close()
-        conn.close()
+        with get_db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT * FROM users order by user_id desc limit 1")
+            max_id_user = cur.fetchall()
+            session['uid'] = max_id_user[0][0] + 1
+            cur.execute(
+                f"INSERT INTO users (user_id, age, gender, occupation, zip_code) VALUES ({current_user()}, {age}, '{sex}', '{occupation}', '{zip_code}')")
+            conn.commit()
+            cur.close()
         print('User successfully added')
         return redirect('/main')
 
@@ -191,53 +270,34 @@ def signup():
 @app.route('/pers_recs', methods=['POST', 'GET'])
 def personal_recs():
     if request.method == 'GET':
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(f'SELECT * FROM ratings where user_id={service.uid}')
-        res = cur.fetchall()
-        if len(res) == 0:
+        with get_db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f'SELECT * FROM ratings where user_id={current_user()}')
+            res = cur.fetchall()
+            cur.close()
+        if len(res) == 0 and not write_buffer.pending_ratings(current_user()):
             return redirect('/unfound_pers_recs')
         else:
-            cf_recs_df = service.cf_model.top_n(service.uid, 10)
-            cf_recs_id = tuple(cf_recs_df['item_id'])
-            # print(recs_df.shape)
-
-            cb_recs_df = service.cb_model.top_n(service.uid, 10)
-            cb_recs_id = tuple(cb_recs_df['item_id'])
-            print(cb_recs_id)
-
-            cur.execute(
-                f"SELECT item_id, title, release_date, imdb_url_new, poster_url FROM full_movies WHERE item_id in {cf_recs_id}")
-            cf_movies_info = pd.DataFrame(cur.fetchall())
-            cf_movies_info.columns = ['item_id', 'title', 'release_date', 'imdb_url', 'poster_url']
-            # print(movies_info.shape)
-
-            cur.execute(
-                f"SELECT item_id, title, release_date, imdb_url_new, poster_url FROM full_movies WHERE item_id in {cb_recs_id}")
-            cb_movies_info = pd.DataFrame(cur.fetchall())
-            cb_movies_info.columns = ['item_id', 'title', 'release_date', 'imdb_url', 'poster_url']
-            print(cb_movies_info)
-
-            cf_top_n_df = cf_recs_df.merge(cf_movies_info, how='inner', on='item_id')
-            cb_top_n_df = cb_recs_df.merge(cb_movies_info, how='inner', on='item_id')
-            print(cb_top_n_df)
-
-            cur.close()
-            conn.close()
-            return render_template('personal_recs.html', user_id=service.uid, cf_recs=cf_top_n_df.values.tolist(),
+            recs = service.recommend(current_user(), 10)
+            cf_recs_df = recs['cf']
+            if cf_recs_df is None:
+                cf_recs_df = pd.DataFrame(columns=['item_id', 'predicted_rating'])
+            cb_recs_df = recs['cb']
+            if cb_recs_df is None:
+                cb_recs_df = pd.DataFrame(columns=['item_id', 'distance'])
+
+            movies_info = service.movies_info(list(cf_recs_df['item_id']) + list(cb_recs_df['item_id']))
+            cf_top_n_df = cf_recs_df.merge(movies_info, how='inner', on='item_id')
+            cb_top_n_df = cb_recs_df.merge(movies_info, how='inner', on='item_id')
+
+            return render_template('personal_recs.html', user_id=current_user(), cf_recs=cf_top_n_df.values.tolist(),
                                    cb_recs=cb_top_n_df.values.tolist())
     elif request.method == 'POST':
         if request.form['btn'] == 'Add to wishlist':
             item_id = request.form['id']
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute(
-                f'INSERT INTO wishlist (user_id, item_id, datetime, from_recommendations) VALUES ({service.uid}, {item_id}, current_date, TRUE )')
-            conn.commit()
-            count = cur.rowcount
-            print(count, "Record inserted successfully into wishlist table")
-            cur.close()
-            conn.close()
+            write_buffer.add_to_wishlist(current_user(), int(item_id), True)
+            service.invalidate(current_user())
+            print("Record queued for wishlist table")
             return redirect(request.url)
         elif request.form['btn'] == 'Rate':
             rating = int(request.form['inlineRadioOptions'])
@@ -246,64 +306,52 @@ def personal_recs():
             print('rated was item with id: ', item_id)
             timestamp = int(time.mktime(datetime.now().timetuple()))
             print('rated timestamp: ', timestamp)
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute(
-                f'INSERT INTO ratings (user_id, item_id, rating, timestamp) VALUES ({service.uid}, {item_id}, {rating}, {timestamp} )')
-            conn.commit()
-            count = cur.rowcount
-            print(count, "record inserted successfully into rating table")
-            cur.close()
-            conn.close()
+            add_rating(item_id, rating, timestamp)
+            print("record queued for rating table")
             return redirect(request.url)
         elif request.form['btn'] == 'Search':
-            service.keyword = request.form['search_movie']
+            session['keyword'] = request.form['search_movie']
             return redirect('/search_result')
 
 
 @app.route('/rated_films', methods=['POST', 'GET'])
 def rated_films():
     if request.method == 'GET':
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            f"SELECT distinct ratings.item_id, title, release_date, imdb_url_new, poster_url, rating, ratings.timestamp FROM ratings left join full_movies on (ratings.item_id=full_movies.item_id) WHERE ratings.user_id = {service.uid} order by ratings.timestamp desc")
-        result = cur.fetchall()
-        cur.close()
-        conn.close()
-        return render_template('rated_films.html', user_id=service.uid, rated_films=result)
+        with get_db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                f"SELECT distinct ratings.item_id, title, release_date, imdb_url_new, poster_url, rating, ratings.timestamp FROM ratings left join full_movies on (ratings.item_id=full_movies.item_id) WHERE ratings.user_id = {current_user()} order by ratings.timestamp desc")
+            result = cur.fetchall()
+            cur.close()
+        result = with_pending_ratings(current_user(), result)
+        return render_template('rated_films.html', user_id=current_user(), rated_films=result)
     else:
         if request.form['btn'] == 'Search':
-            service.keyword = request.form['search_movie']
+            session['keyword'] = request.form['search_movie']
             return redirect('/search_result')
 
 
 @app.route('/wishlist', methods=['POST', 'GET'])
 def wishlist():
     if request.method == 'GET':
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            f'SELECT distinct wishlist.item_id, title, release_date, imdb_url_new, datetime FROM wishlist inner join full_movies on (wishlist.item_id=full_movies.item_id) WHERE user_id={service.uid} ORDER BY datetime desc')
-        result = cur.fetchall()
-        cur.close()
-        conn.close()
-        return render_template('wishlist.html', user_id=service.uid, wishlist=result)
+        with get_db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                f'SELECT distinct wishlist.item_id, title, release_date, imdb_url_new, datetime FROM wishlist inner join full_movies on (wishlist.item_id=full_movies.item_id) WHERE user_id={current_user()} ORDER BY datetime desc')
+            result = cur.fetchall()
+            cur.close()
+        result = with_pending_wishlist(current_user(), result)
+        return render_template('wishlist.html', user_id=current_user(), wishlist=result)
     else:
         if request.form['btn'] == 'Delete':
             print('Delete request')
             movie_id = request.form['id']
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute(
-                f'DELETE FROM wishlist WHERE user_id={service.uid} AND item_id={movie_id}')
-            conn.commit()
-            print('Row deleted')
-            cur.close()
-            conn.close()
+            write_buffer.remove_from_wishlist(current_user(), int(movie_id))
+            service.invalidate(current_user())
+            print('Row deletion queued')
             return redirect(request.url)
         elif request.form['btn'] == 'Search':
-            service.keyword = request.form['search_movie']
+            session['keyword'] = request.form['search_movie']
             return redirect('/search_result')
         elif request.form['btn'] == 'Rate':
             rating = int(request.form['inlineRadioOptions'])
@@ -312,43 +360,23 @@ def wishlist():
             print('rated was item with id: ', item_id)
             timestamp = int(time.mktime(datetime.now().timetuple()))
             print('rated timestamp: ', timestamp)
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute(
-                f'INSERT INTO ratings (user_id, item_id, rating, timestamp) VALUES ({service.uid}, {item_id}, {rating}, {timestamp} )')
-            conn.commit()
-            cur.execute(f'DELETE FROM wishlist WHERE user_id={service.uid} AND item_id={item_id}')
-            conn.commit()
-            count = cur.rowcount
-            print(count, "record inserted successfully into rating table")
-            cur.close()
-            conn.close()
+            add_rating(item_id, rating, timestamp)
+            write_buffer.remove_from_wishlist(current_user(), int(item_id))
+            print("record queued for rating table")
             return redirect(request.url)
 
 
 @app.route('/search_result', methods=['POST', 'GET'])
 def search():
     if request.method == 'GET':
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            f"SELECT item_id, title, release_date, imdb_url_new FROM full_movies WHERE lower(title) like '%{service.keyword}%'")
-        result = cur.fetchall()
-        cur.close()
-        conn.close()
-        return render_template('loged_search_result.html', user_id=service.uid, films=result)
+        result = search_index.search(session.get('keyword'))
+        return render_template('loged_search_result.html', user_id=current_user(), films=result)
     else:
         if request.form['btn'] == 'Add to wishlist':
             item_id = request.form['id']
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute(
-                f'INSERT INTO wishlist (user_id, item_id, datetime, from_recommendations) VALUES ({service.uid}, {item_id}, current_date, FALSE )')
-            conn.commit()
-            count = cur.rowcount
-            print(count, "Record inserted successfully into wishlist table")
-            cur.close()
-            conn.close()
+            write_buffer.add_to_wishlist(current_user(), int(item_id), False)
+            service.invalidate(current_user())
+            print("Record queued for wishlist table")
             return redirect(request.url)
         elif request.form['btn'] == 'Rate':
             rating = int(request.form['inlineRadioOptions'])
@@ -357,32 +385,60 @@ def search():
             print('rated was item with id: ', item_id)
             timestamp = int(time.mktime(datetime.now().timetuple()))
             print('rated timestamp: ', timestamp)
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute(
-                f'INSERT INTO ratings (user_id, item_id, rating, timestamp) VALUES ({service.uid}, {item_id}, {rating}, {timestamp} )')
-            conn.commit()
-            count = cur.rowcount
-            print(count, "record inserted successfully into rating table")
-            cur.close()
-            conn.close()
+            add_rating(item_id, rating, timestamp)
+            print("record queued for rating table")
             return redirect(request.url)
 
 @app.route('/unloged_search_result')
 def unloged_search():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        f"SELECT item_id, title, release_date, imdb_url_new FROM full_movies WHERE lower(title) like '%{service.keyword}%'")
-    result = cur.fetchall()
-    cur.close()
-    conn.close()
+    result = search_index.search(session.get('keyword'))
     return render_template('unloged_search_result.html', films=result)
 
 
+@app.route('/autocomplete')
+def autocomplete():
+    # нечислове limit - як без нього, решта обрізається до 1..MAX_AUTOCOMPLETE_LIMIT
+    limit = min(max(request.args.get('limit', 10, type=int), 1), MAX_AUTOCOMPLETE_LIMIT)
+    titles = search_index.complete(request.args.get('q', ''), limit)
+    return jsonify([{'item_id': item_id, 'title': title} for item_id, title, _, _ in titles])
+
+
+@app.route('/api/recommendations', methods=['POST'])
+def api_recommendations():
+    # {"users": [1, 2, ...], "model": "cf" | "cb" | "hybrid", "n": 10} -> NDJSON, один рядок на користувача
+    params = request.get_json(silent=True) or {}
+    users = params.get('users')
+    model_name = params.get('model', 'cf')
+    n = params.get('n', 10)
+    if not isinstance(users, list) or not all(isinstance(user, int) for user in users):
+        return jsonify({'error': 'users must be a list of user ids'}), 400
+    if len(users) > MAX_BATCH_USERS:
+        return jsonify({'error': f'at most {MAX_BATCH_USERS} users per request'}), 400
+    if model_name not in ('cf', 'cb', 'hybrid'):
+        return jsonify({'error': 'model must be one of cf, cb, hybrid'}), 400
+    if not isinstance(n, int) or not 1 <= n <= MAX_BATCH_N:
+        return jsonify({'error': f'n must be an integer from 1 to {MAX_BATCH_N}'}), 400
+
+    def generate():
+        for user, recs in service.recommend_batch(users, n, model_name):
+            if recs is None:
+                line = {'user_id': user, 'model': model_name, 'error': 'unknown user'}
+            else:
+                line = {'user_id': user, 'model': model_name, 'recommendations': recs.to_dict('records')}
+            # numpy-скаляри (int64) json не серіалізує сам
+            yield json.dumps(line, default=lambda value: value.item()) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
 @app.route('/unfound_pers_recs')
 def unfound_pers_recs():
-    return render_template('unfound_pers_recs.html', user_id=service.uid)
+    # оцінок ще немає: найкращі фільми серед користувачів того ж віку, статі, професії та регіону
+    recs_df = service.fallback_top_n(current_user(), 10)
+    if recs_df is None:
+        recs_df = pd.DataFrame(columns=['item_id', 'score'])
+    top_n_df = recs_df.merge(service.movies_info(recs_df['item_id']), how='inner', on='item_id')
+    return render_template('unfound_pers_recs.html', user_id=current_user(), recs=top_n_df.values.tolist())
 
 
 if __name__ == '__main__':
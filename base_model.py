@@ -1,56 +1,376 @@
-import pickle
+import os
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 
 import numpy as np
 import pandas as pd
 from annoy import AnnoyIndex
+from scipy import sparse as sp
 from sklearn.decomposition import NMF
 from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.preprocessing import MinMaxScaler
+from sklearn.preprocessing import MinMaxScaler, normalize
+
+import model_store
 
 
 def evaluation(prediction_df):
-    prediction_df_copy = deepcopy(prediction_df)
-    prediction_df_copy['abs_delta'] = abs(prediction_df['rating'] - prediction_df['predicted_rating'])
-    prediction_df_copy['squared_delta'] = (prediction_df['rating'] - prediction_df['predicted_rating']) ** 2
-    mae = prediction_df_copy.groupby('user_id')['abs_delta'].mean().mean()
-    mse = prediction_df_copy.groupby('user_id')['squared_delta'].mean().mean()
+    delta = prediction_df['rating'] - prediction_df['predicted_rating']
+    users = prediction_df['user_id']
+    mae = delta.abs().groupby(users).mean().mean()
+    mse = (delta ** 2).groupby(users).mean().mean()
     rmse = np.sqrt(mse)
     return mae, rmse
 
 
+def sparse_rating_matrix(train_df):
+    # CSR users x items, зберігаються лише наявні оцінки
+    ratings = train_df.groupby(['user_id', 'item_id'])['rating'].mean()
+    user_ids = pd.Index(ratings.index.get_level_values('user_id').unique())
+    item_ids = pd.Index(np.sort(ratings.index.get_level_values('item_id').unique()))
+    user_rows = user_ids.get_indexer(ratings.index.get_level_values('user_id'))
+    film_cols = item_ids.get_indexer(ratings.index.get_level_values('item_id'))
+    rating_matrix = sp.csr_matrix((ratings.to_numpy(dtype=float), (user_rows, film_cols)),
+                                  shape=(len(user_ids), len(item_ids)))
+    return rating_matrix, user_ids, item_ids
+
+
+def sparse_preference_matrix(rating_matrix, user_ids):
+    ratings_count = np.diff(rating_matrix.indptr)
+    mean_users_rating = np.asarray(rating_matrix.sum(axis=1)).ravel() / ratings_count
+    preference_matrix = rating_matrix.copy()
+    preference_matrix.data -= np.repeat(mean_users_rating, ratings_count)
+    return pd.Series(mean_users_rating, index=user_ids), preference_matrix
+
+
+def top_k_neighbours(vectors, top_k, threshold, block_size=1024, exclude_self=False):
+    # косинусна близькість між рядками vectors рахується блоками по block_size рядків,
+    # з кожного блоку лишаємо top_k сусідів з близькістю > threshold, відсортованих за спаданням
+    normalized_vectors = normalize(vectors)
+    rows_count = normalized_vectors.shape[0]
+    top_k = min(top_k, rows_count)
+    neighbours_index = np.full((rows_count, top_k), -1, dtype=np.int32)
+    neighbours_similarity = np.zeros((rows_count, top_k), dtype=np.float32)
+
+    for start in range(0, rows_count, block_size):
+        block_distances = normalized_vectors[start:start + block_size] @ normalized_vectors.T
+        if sp.issparse(block_distances):
+            block_distances = block_distances.toarray()
+        block_rows = np.arange(len(block_distances))
+        if exclude_self:
+            block_distances[block_rows, start + block_rows] = -np.inf
+        nearest = np.argpartition(-block_distances, top_k - 1, axis=1)[:, :top_k]
+        nearest_distances = np.take_along_axis(block_distances, nearest, axis=1)
+        order = np.argsort(-nearest_distances, axis=1, kind='stable')
+        nearest = np.take_along_axis(nearest, order, axis=1)
+        nearest_distances = np.take_along_axis(nearest_distances, order, axis=1)
+
+        above_threshold = nearest_distances > threshold
+        block = slice(start, start + len(block_distances))
+        neighbours_index[block] = np.where(above_threshold, nearest, -1)
+        neighbours_similarity[block] = np.where(above_threshold, nearest_distances, 0)
+    return neighbours_index, neighbours_similarity
+
+
+def top_n_scores(scores, n):
+    # n найбільших значень у кожному рядку scores, відсортованих за спаданням; -inf - виключені фільми
+    n = min(n, scores.shape[1])
+    top = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+def exclude_watched(scores, watched_rows):
+    # watched_rows - CSR з рядками користувачів блоку, їхні переглянуті фільми отримують -inf
+    rows = np.repeat(np.arange(watched_rows.shape[0]), np.diff(watched_rows.indptr))
+    scores[rows, watched_rows.indices] = -np.inf
+    return scores
+
+
 class BaseModel:
     def __init__(self):
         self.model_name = None
+        self.training_data = None
 
     def fit(self):
         pass
 
-    def predict(self):
-        pass
+    def predict_batch(self, users, films):
+        # прогноз для масивів пар (user, film): для невідомого фільму - середня оцінка користувача,
+        # для невідомого користувача - середня оцінка фільму, для відомих пар - _predict_pairs моделі
+        with self.model_lock():
+            users = np.asarray(users)
+            films = np.asarray(films)
+            user_rows = self.user_ids.get_indexer(users)
+            film_cols = self.item_ids.get_indexer(films)
+            known_user = user_rows >= 0
+            known_film = film_cols >= 0
+            rating_prediction = np.empty(len(users), dtype=float)
+
+            # film unknown
+            if (~known_film).any():
+                rating_prediction[~known_film] = self.mean_users_rating.loc[users[~known_film]].to_numpy()
+
+            # user unknown
+            unknown_user = ~known_user & known_film
+            rating_prediction[unknown_user] = self.mean_items_rating[film_cols[unknown_user]]
+
+            # all info known
+            known = known_user & known_film
+            rating_prediction[known] = self._predict_pairs(user_rows[known], film_cols[known])
+            return rating_prediction
+
+    def _predict_pairs(self, user_rows, film_cols):
+        raise NotImplementedError
+
+    def predict_one(self, user, film):
+        return self.predict_batch([user], [film])[0]
 
-    def save_model(self):
-        pickle.dump(self, open(f'models/{self.model_name}.pickle', 'wb'))
+    def predict(self, test_df):
+        test_df_copy = deepcopy(test_df)
+        test_df_copy['predicted_rating'] = self.predict_batch(test_df['user_id'], test_df['item_id'])
+        return test_df_copy
+
+    def top_n(self, user, n=10):
+        # той самий розрахунок, що й для top_n_batch і попередньо порахованих рекомендацій, тож фільми
+        # з однаковими оцінками йдуть в однаковому порядку; невідомий користувач - KeyError, як у get_loc
+        recs = self.top_n_batch([user], n)[0]
+        if recs is None:
+            raise KeyError(user)
+        return recs
+
+    def top_n_batch(self, users, n=10, batch_size=256):
+        # top_n для багатьох користувачів: оцінки рахуються матрицею batch_size x фільми за раз;
+        # для невідомих користувачів - None
+        with self.model_lock():
+            users = np.asarray(users)
+            user_rows = self.user_ids.get_indexer(users)
+            recs = [None] * len(users)
+            known = np.flatnonzero(user_rows >= 0)
+            for start in range(0, len(known), batch_size):
+                chunk = known[start:start + batch_size]
+                top, top_scores = top_n_scores(self._predicted_ratings(user_rows[chunk]), n)
+                for position, user_top, user_scores in zip(chunk, top, top_scores):
+                    found = np.isfinite(user_scores)
+                    recs[position] = pd.DataFrame({'item_id': self.item_ids[user_top[found]],
+                                                   'predicted_rating': user_scores[found]})
+            return recs
+
+    def save_model(self, path=model_store.ARTIFACTS_PATH):
+        return model_store.save(self, path)
+
+    def model_lock(self):
+        # update змінює кілька атрибутів по черзі, тому читання моделі з інших потоків теж іде під цим локом;
+        # моделі з артефакту створюються без __init__, тож лок з'являється при першому зверненні
+        return self.__dict__.setdefault('_lock', threading.RLock())
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('_lock', None)
+        return state
+
+    def __getattr__(self, name):
+        # атрибути моделі, завантаженої з артефакту, читаються з диска при першому зверненні
+        artifact = self.__dict__.get('_artifact')
+        if artifact is None or name not in artifact.attributes:
+            raise AttributeError(f'{type(self).__name__!r} object has no attribute {name!r}')
+        return artifact.load_attribute(self, name)
 
 
 class CollaborativeFilteringModel(BaseModel):
     # TODO: limit to predicted rating: where to force it?
-    def __init__(self):
+    def __init__(self, sparse=False):
         self.model_name = 'collaborative_filtering'
+        self.training_data = None
+        self.sparse = sparse
+        self.user_ids = None
+        self.item_ids = None
         self.rating_matrix = None
         self.mean_users_rating = None
         self.preference_matrix = None
+        self.rating_matrix_csc = None
+        self.preference_matrix_csc = None
         self.cosine_matrix = None
         self.users_distances = None
+        self.neighbours_index = None
+        self.neighbours_similarity = None
+        self.neighbours_threshold = None
+
+    def fit(self, train_df, top_k=None, threshold=0.15, block_size=1024):
+        # top_k: замість повної матриці U x U зберігаємо лише top_k найближчих сусідів кожного користувача
+        self.training_data = model_store.training_data_summary(train_df)
+        if self.sparse:
+            self._fit_sparse(train_df)
+        else:
+            self._fit_dense(train_df)
 
-    def fit(self, train_df):
+        if top_k is not None:
+            self._build_neighbours_index(top_k, threshold, block_size)
+        else:
+            self.cosine_matrix = cosine_similarity(self.preference_matrix)
+            if not self.sparse:
+                self.users_distances = pd.DataFrame(self.cosine_matrix,
+                                                    index=self.rating_matrix.index,
+                                                    columns=self.rating_matrix.index)
+
+    def _fit_dense(self, train_df):
         self.rating_matrix = pd.pivot_table(train_df, values='rating', index='user_id', columns=['item_id'])
+        self.user_ids = self.rating_matrix.index
+        self.item_ids = self.rating_matrix.columns
         self.mean_users_rating = self.rating_matrix.mean(axis=1)
         self.preference_matrix = self.rating_matrix.subtract(self.mean_users_rating, axis=0).fillna(0)
-        self.cosine_matrix = cosine_similarity(self.preference_matrix)
-        self.users_distances = pd.DataFrame(self.cosine_matrix,
-                                            index=self.rating_matrix.index,
-                                            columns=self.rating_matrix.index)
+
+    def _fit_sparse(self, train_df):
+        # rating_matrix і preference_matrix - CSR users x items, зберігаються лише наявні оцінки
+        self.rating_matrix, self.user_ids, self.item_ids = sparse_rating_matrix(train_df)
+        self.mean_users_rating, self.preference_matrix = sparse_preference_matrix(self.rating_matrix,
+                                                                                  self.user_ids)
+        self.rating_matrix_csc = self.rating_matrix.tocsc()
+        self.preference_matrix_csc = self.preference_matrix.tocsc()
+
+    def _build_neighbours_index(self, top_k, threshold, block_size):
+        preferences = self.preference_matrix if self.sparse else self.preference_matrix.to_numpy()
+        self.neighbours_index, self.neighbours_similarity = top_k_neighbours(preferences, top_k, threshold,
+                                                                             block_size)
+        self.neighbours_threshold = threshold
+
+    def update(self, user, film, rating):
+        # додаємо одну нову оцінку без перенавчання: змінюються лише рядок користувача,
+        # його середня оцінка та його близькість до інших користувачів
+        with self.model_lock():
+            if film not in self.item_ids:
+                self._add_film(film)
+            if user not in self.user_ids:
+                self._add_user(user)
+            user_row = self.user_ids.get_loc(user)
+            film_col = self.item_ids.get_loc(film)
+
+            if self.sparse:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', sp.SparseEfficiencyWarning)
+                    self.rating_matrix[user_row, film_col] = rating
+                    self.preference_matrix[user_row, film_col] = rating
+                row = slice(self.rating_matrix.indptr[user_row], self.rating_matrix.indptr[user_row + 1])
+                mean_user_rating = self.rating_matrix.data[row].mean()
+                self.preference_matrix.data[row] = self.rating_matrix.data[row] - mean_user_rating
+                self._update_sparse_columns(user_row, film_col, rating, row)
+                preferences = self.preference_matrix
+                user_preferences = self.preference_matrix[user_row]
+            else:
+                self.rating_matrix.iat[user_row, film_col] = rating
+                mean_user_rating = self.rating_matrix.iloc[user_row].mean()
+                self.preference_matrix.iloc[user_row] = (self.rating_matrix.iloc[user_row] - mean_user_rating).fillna(0)
+                preferences = self.preference_matrix.to_numpy()
+                user_preferences = preferences[[user_row]]
+            self.mean_users_rating.iloc[user_row] = mean_user_rating
+
+            user_distances = cosine_similarity(user_preferences, preferences)[0]
+            if self.neighbours_index is not None:
+                self._update_neighbours_index(user_row, user_distances)
+            elif self.__dict__.get('_artifact') is not None:
+                # cosine_matrix відображена з артефакту і спільна для воркерів: запис стовпця зачепив би
+                # кожну її сторінку і зробив би приватну копію U x U, тож близькість пишеться поруч
+                # і живе до перезавантаження моделі
+                self.__dict__.setdefault('_updated_similarity', {})[user_row] = user_distances
+            else:
+                self.cosine_matrix[user_row, :] = user_distances
+                self.cosine_matrix[:, user_row] = user_distances
+                if self.users_distances is not None:
+                    self.users_distances.iloc[user_row, :] = user_distances
+                    self.users_distances.iloc[:, user_row] = user_distances
+
+    def can_update(self, user, film):
+        # у моделі з артефакту новий користувач чи фільм перевиділив би матриці U x I і U x U в пам'яті
+        # процесу: такі оцінки чекають перенавчання, а нових користувачів до того обслуговує fallback сервісу
+        return self.__dict__.get('_artifact') is None or (user in self.user_ids and film in self.item_ids)
+
+    def _similarity_rows(self, user_rows):
+        # рядки cosine_matrix разом з онлайн-оновленнями близькості
+        user_distances = self.cosine_matrix[user_rows]
+        updated_similarity = self.__dict__.get('_updated_similarity')
+        if updated_similarity:
+            for row, distances in updated_similarity.items():
+                user_distances[:, row] = distances[user_rows]
+            for i, row in enumerate(user_rows):
+                if row in updated_similarity:
+                    user_distances[i] = updated_similarity[row]
+        return user_distances
+
+    def _sparse_columns(self):
+        # CSC-копії rating_matrix і preference_matrix для вибірки за фільмами: рахуються при fit і
+        # оновлюються в update; для моделей, збережених без них, - один раз при першому зверненні
+        if getattr(self, 'rating_matrix_csc', None) is None:
+            self.rating_matrix_csc = self.rating_matrix.tocsc()
+            self.preference_matrix_csc = self.preference_matrix.tocsc()
+        return self.rating_matrix_csc, self.preference_matrix_csc
+
+    def _update_sparse_columns(self, user_row, film_col, rating, row):
+        # нова оцінка і весь рядок переваг користувача: після зміни середньої змінюються всі його елементи
+        ratings, preferences = self._sparse_columns()
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', sp.SparseEfficiencyWarning)
+            ratings[user_row, film_col] = rating
+            preferences[user_row, self.preference_matrix.indices[row]] = self.preference_matrix.data[row]
+
+    def _add_film(self, film):
+        if self.sparse:
+            for matrix in (self.rating_matrix, self.preference_matrix) + self._sparse_columns():
+                matrix.resize((len(self.user_ids), len(self.item_ids) + 1))
+            self.item_ids = self.item_ids.append(pd.Index([film]))
+        else:
+            self.rating_matrix[film] = np.nan
+            self.preference_matrix[film] = 0.0
+            self.item_ids = self.rating_matrix.columns
+
+    def _add_user(self, user):
+        if self.sparse:
+            for matrix in (self.rating_matrix, self.preference_matrix) + self._sparse_columns():
+                matrix.resize((len(self.user_ids) + 1, len(self.item_ids)))
+            self.user_ids = self.user_ids.append(pd.Index([user]))
+        else:
+            self.rating_matrix.loc[user] = np.nan
+            self.preference_matrix.loc[user] = 0.0
+            self.user_ids = self.rating_matrix.index
+        self.mean_users_rating.loc[user] = np.nan
+
+        if self.neighbours_index is not None:
+            top_k = self.neighbours_index.shape[1]
+            self.neighbours_index = np.vstack([self.neighbours_index, np.full((1, top_k), -1, dtype=np.int32)])
+            self.neighbours_similarity = np.vstack([self.neighbours_similarity,
+                                                    np.zeros((1, top_k), dtype=np.float32)])
+        else:
+            self.cosine_matrix = np.pad(self.cosine_matrix, ((0, 1), (0, 1)))
+            if self.users_distances is not None:
+                self.users_distances = pd.DataFrame(self.cosine_matrix, index=self.user_ids, columns=self.user_ids)
+
+    def _update_neighbours_index(self, user_row, user_distances):
+        top_k = self.neighbours_index.shape[1]
+        threshold = self.neighbours_threshold
+        nearest = np.argsort(-user_distances, kind='stable')[:top_k]
+        above_threshold = user_distances[nearest] > threshold
+        self.neighbours_index[user_row] = np.where(above_threshold, nearest, -1)
+        self.neighbours_similarity[user_row] = np.where(above_threshold, user_distances[nearest], 0)
+
+        # у списках інших користувачів оновлюємо лише цього користувача;
+        # якщо він випадає зі списку, місце лишається порожнім до наступного fit
+        contains_user = (self.neighbours_index == user_row).any(axis=1)
+        can_enter = (user_distances > threshold) & \
+                    ((user_distances > self.neighbours_similarity[:, -1]) | (self.neighbours_index[:, -1] < 0))
+        affected_rows = np.flatnonzero(contains_user | can_enter)
+        for row in affected_rows[affected_rows != user_row]:
+            row_index = self.neighbours_index[row]
+            keep = (row_index >= 0) & (row_index != user_row)
+            candidates = np.append(row_index[keep], user_row)
+            candidates_distances = np.append(self.neighbours_similarity[row][keep], user_distances[row])
+            if user_distances[row] <= threshold:
+                candidates, candidates_distances = candidates[:-1], candidates_distances[:-1]
+            order = np.argsort(-candidates_distances, kind='stable')[:top_k]
+            self.neighbours_index[row] = -1
+            self.neighbours_similarity[row] = 0
+            self.neighbours_index[row, :len(order)] = candidates[order]
+            self.neighbours_similarity[row, :len(order)] = candidates_distances[order]
 
     def predict_one(self, user, film, neighbours=10, threshold=0.15):
         # 1) берем тих, хто дивився фільм
@@ -58,59 +378,241 @@ class CollaborativeFilteringModel(BaseModel):
         # 3) лишаємо тих, хто по близькості перевищує поріг
         # 4) знаходимо ваги для кожного сусіда
         # 5) обчислюємо прогнозований рейтинг
-
-        if user in self.rating_matrix.index and film in self.rating_matrix.columns:
-            users_who_saw_film = self.rating_matrix.loc[:, film].notnull()
-            user_distances = self.users_distances.loc[users_who_saw_film].loc[:, user]
-            filtered_distances = user_distances[user_distances > threshold].sort_values(ascending=False).head(
-                neighbours)
-            users_weights = filtered_distances / sum(filtered_distances)
-            users_preferences = self.preference_matrix.loc[users_weights.index, film]
-            user_delta = users_weights.dot(users_preferences)
-            rating_prediction = self.mean_users_rating.loc[user] + user_delta
-            # print('all info known')
-        elif film in self.rating_matrix.columns:
-            rating_prediction = self.rating_matrix.loc[:, film].mean()
-            # print('user unknown')
+        with self.model_lock():
+            if self.users_distances is None or self.__dict__.get('_updated_similarity'):
+                return self.predict_batch([user], [film], neighbours, threshold)[0]
+
+            if user in self.rating_matrix.index and film in self.rating_matrix.columns:
+                users_who_saw_film = self.rating_matrix.loc[:, film].notnull()
+                user_distances = self.users_distances.loc[users_who_saw_film].loc[:, user]
+                filtered_distances = user_distances[user_distances > threshold].sort_values(ascending=False).head(
+                    neighbours)
+                users_weights = filtered_distances / sum(filtered_distances)
+                users_preferences = self.preference_matrix.loc[users_weights.index, film]
+                user_delta = users_weights.dot(users_preferences)
+                rating_prediction = self.mean_users_rating.loc[user] + user_delta
+                # print('all info known')
+            elif film in self.rating_matrix.columns:
+                rating_prediction = self.rating_matrix.loc[:, film].mean()
+                # print('user unknown')
+            else:
+                rating_prediction = self.mean_users_rating.loc[user]
+                # print('film unknown')
+
+            return rating_prediction
+
+    def predict_batch(self, users, films, neighbours=10, threshold=0.15, batch_size=4096):
+        # ті самі кроки, що й у predict_one, але для масивів пар (user, film) одразу
+        with self.model_lock():
+            users = np.asarray(users)
+            films = np.asarray(films)
+            user_rows = self.user_ids.get_indexer(users)
+            film_cols = self.item_ids.get_indexer(films)
+            known_user = user_rows >= 0
+            known_film = film_cols >= 0
+
+            if self.sparse:
+                ratings, preferences = self._sparse_columns()
+            else:
+                ratings = self.rating_matrix.to_numpy()
+                preferences = self.preference_matrix.to_numpy()
+            rating_prediction = np.empty(len(users), dtype=float)
+
+            # film unknown
+            if (~known_film).any():
+                rating_prediction[~known_film] = self.mean_users_rating.loc[users[~known_film]].to_numpy()
+
+            # user unknown
+            unknown_user = ~known_user & known_film
+            if unknown_user.any():
+                if self.sparse:
+                    mean_films_rating = np.asarray(ratings.sum(axis=0)).ravel() / np.diff(ratings.indptr)
+                    rating_prediction[unknown_user] = mean_films_rating[film_cols[unknown_user]]
+                else:
+                    rating_prediction[unknown_user] = np.nanmean(ratings[:, film_cols[unknown_user]], axis=0)
+
+            # all info known
+            known = np.flatnonzero(known_user & known_film)
+            for start in range(0, len(known), batch_size):
+                chunk = known[start:start + batch_size]
+                rating_prediction[chunk] = self._predict_known(ratings, preferences, user_rows[chunk],
+                                                               film_cols[chunk], neighbours, threshold)
+            return rating_prediction
+
+    def _predict_known(self, ratings, preferences, user_rows, film_cols, neighbours, threshold):
+        if self.neighbours_index is not None:
+            return self._predict_known_from_index(ratings, preferences, user_rows, film_cols, neighbours, threshold)
+
+        if self.sparse:
+            users_who_saw_film = ratings[:, film_cols].T.toarray() != 0
+            users_preferences = preferences[:, film_cols].T.toarray()
         else:
-            rating_prediction = self.mean_users_rating.loc[user]
-            # print('film unknown')
-
-        return rating_prediction
-
-    def predict(self, test_df):
-        prediction_list = []
-        # TODO optimize: change row-wise to df
-        for user, film in zip(test_df['user_id'], test_df['item_id']):
-            prediction_list.append(self.predict_one(user, film))
+            users_who_saw_film = ~np.isnan(ratings[:, film_cols].T)
+            users_preferences = preferences[:, film_cols].T
+        user_distances = self._similarity_rows(user_rows)
+        filtered_distances = np.where(users_who_saw_film & (user_distances > threshold), user_distances, -np.inf)
+
+        if neighbours < filtered_distances.shape[1]:
+            nearest = np.argpartition(-filtered_distances, neighbours - 1, axis=1)[:, :neighbours]
+            filtered_distances = np.take_along_axis(filtered_distances, nearest, axis=1)
+            users_preferences = np.take_along_axis(users_preferences, nearest, axis=1)
+
+        filtered_distances = np.where(np.isfinite(filtered_distances), filtered_distances, 0)
+        distances_sum = filtered_distances.sum(axis=1)
+        user_delta = np.divide((filtered_distances * users_preferences).sum(axis=1), distances_sum,
+                               out=np.zeros(len(user_rows)), where=distances_sum != 0)
+        return self.mean_users_rating.to_numpy()[user_rows] + user_delta
+
+    def _predict_known_from_index(self, ratings, preferences, user_rows, film_cols, neighbours, threshold):
+        # сусіди в індексі вже відсортовані, тому достатньо взяти перших neighbours, хто дивився фільм
+        nearest = self.neighbours_index[user_rows]
+        nearest_rows = np.where(nearest >= 0, nearest, 0)
+        nearest_cols = np.broadcast_to(film_cols[:, None], nearest.shape)
+        if self.sparse:
+            nearest_ratings = np.asarray(self.rating_matrix[nearest_rows.ravel(), nearest_cols.ravel()]).ravel()
+            users_who_saw_film = nearest_ratings.reshape(nearest.shape) != 0
+            users_preferences = np.asarray(
+                self.preference_matrix[nearest_rows.ravel(), nearest_cols.ravel()]).reshape(nearest.shape)
+        else:
+            users_who_saw_film = ~np.isnan(ratings[nearest_rows, nearest_cols])
+            users_preferences = preferences[nearest_rows, nearest_cols]
+
+        user_distances = self.neighbours_similarity[user_rows].astype(float)
+        filtered = (nearest >= 0) & users_who_saw_film & (user_distances > threshold)
+        filtered &= np.cumsum(filtered, axis=1) <= neighbours
+        filtered_distances = np.where(filtered, user_distances, 0)
+
+        distances_sum = filtered_distances.sum(axis=1)
+        user_delta = np.divide((filtered_distances * users_preferences).sum(axis=1), distances_sum,
+                               out=np.zeros(len(user_rows)), where=distances_sum != 0)
+        return self.mean_users_rating.to_numpy()[user_rows] + user_delta
+
+    def predict(self, test_df, batched=True):
+        if batched:
+            prediction_list = self.predict_batch(test_df['user_id'], test_df['item_id'])
+        else:
+            prediction_list = []
+            for user, film in zip(test_df['user_id'], test_df['item_id']):
+                prediction_list.append(self.predict_one(user, film))
 
         test_df_copy = deepcopy(test_df)
         test_df_copy['predicted_rating'] = prediction_list
         return test_df_copy
 
-    def top_n(self, user, n=10):
-        watched_movies_id = self.rating_matrix.loc[user, self.rating_matrix.loc[user, :].notnull()].index
-        df = pd.DataFrame({'user_id': [user] * (len(self.rating_matrix.columns)-len(watched_movies_id)),
-                           'item_id': [movie for movie in self.rating_matrix.columns if
-                                       movie not in watched_movies_id]})
-        prediction = self.predict(df) \
-            .sort_values('predicted_rating', ascending=False) \
-            .drop(['user_id'], axis=1) \
-            .head(n)
-        return prediction
+    def _predicted_ratings(self, user_rows, neighbours=10, threshold=0.15):
+        with self.model_lock():
+            if self.sparse:
+                watched_movies = self.rating_matrix[user_rows].toarray() != 0
+            else:
+                watched_movies = self.rating_matrix.iloc[user_rows].notnull().to_numpy()
+            if self.neighbours_index is not None:
+                rows, cols = np.nonzero(~watched_movies)
+                predicted_rating = np.full(watched_movies.shape, -np.inf)
+                predicted_rating[rows, cols] = self.predict_batch(self.user_ids[user_rows[rows]], self.item_ids[cols],
+                                                                  neighbours, threshold)
+            else:
+                predicted_rating = self._predicted_ratings_by_film(user_rows, neighbours, threshold)
+                predicted_rating[watched_movies] = -np.inf
+            return predicted_rating
+
+    def _predicted_ratings_by_film(self, user_rows, neighbours, threshold):
+        # з повною матрицею близькості: для кожного фільму сусіди шукаються лише серед тих, хто його дивився;
+        # для кожного користувача блоку всі оцінки (фільм, хто оцінив) обробляються разом: лишаються сусіди
+        # над порогом, сортуються за фільмом і спаданням близькості, і кожен фільм бере перших neighbours,
+        # тож один користувач (top_n) рахується так само швидко, як і у великому блоці
+        mean_users_rating = self.mean_users_rating.to_numpy()
+        if self.sparse:
+            ratings, _ = self._sparse_columns()
+            films = np.repeat(np.arange(len(self.item_ids)), np.diff(ratings.indptr))
+            raters, values = ratings.indices, ratings.data
+        else:
+            ratings = self.rating_matrix.to_numpy()
+            films, raters = np.nonzero(~np.isnan(ratings.T))
+            values = ratings[raters, films]
+        users_preferences = values - mean_users_rating[raters]
+        user_distances = self._similarity_rows(user_rows)
+        user_delta = np.zeros((len(user_rows), len(self.item_ids)))
+
+        for i, distances in enumerate(user_distances):
+            distances = distances[raters]
+            above_threshold = np.flatnonzero(distances > threshold)
+            nearest = above_threshold[np.lexsort((-distances[above_threshold], films[above_threshold]))]
+            nearest_films = films[nearest]
+            rank = np.arange(len(nearest)) - np.searchsorted(nearest_films, nearest_films)
+            nearest = nearest[rank < neighbours]
+            weighted_sum = np.bincount(films[nearest], distances[nearest] * users_preferences[nearest],
+                                       minlength=len(self.item_ids))
+            distances_sum = np.bincount(films[nearest], distances[nearest], minlength=len(self.item_ids))
+            user_delta[i] = np.divide(weighted_sum, distances_sum, out=np.zeros(len(weighted_sum)),
+                                      where=distances_sum != 0)
+        return mean_users_rating[user_rows, None] + user_delta
 
     def accuracy(self):
         pass
 
 
+class ItemBasedCollaborativeFilteringModel(BaseModel):
+    def __init__(self):
+        self.model_name = 'item_based_collaborative_filtering'
+        self.training_data = None
+        self.user_ids = None
+        self.item_ids = None
+        self.rating_matrix = None
+        self.mean_users_rating = None
+        self.mean_items_rating = None
+        self.preference_matrix = None
+        self.similarity_matrix = None
+
+    def fit(self, train_df, neighbours=30, threshold=0.15, block_size=1024):
+        # similarity_matrix - CSR items x items, в кожному рядку лише neighbours найближчих фільмів
+        self.training_data = model_store.training_data_summary(train_df)
+        self.rating_matrix, self.user_ids, self.item_ids = sparse_rating_matrix(train_df)
+        self.mean_users_rating, self.preference_matrix = sparse_preference_matrix(self.rating_matrix,
+                                                                                  self.user_ids)
+        ratings = self.rating_matrix.tocsc()
+        self.mean_items_rating = np.asarray(ratings.sum(axis=0)).ravel() / np.diff(ratings.indptr)
+
+        neighbours_index, neighbours_similarity = top_k_neighbours(self.preference_matrix.T.tocsr(), neighbours,
+                                                                   threshold, block_size, exclude_self=True)
+        items_count = len(self.item_ids)
+        known_neighbours = neighbours_index >= 0
+        self.similarity_matrix = sp.csr_matrix(
+            (neighbours_similarity[known_neighbours].astype(float),
+             (np.nonzero(known_neighbours)[0], neighbours_index[known_neighbours])),
+            shape=(items_count, items_count))
+
+    def _predict_pairs(self, user_rows, film_cols):
+        # зважена сума відхилень користувача по сусідніх фільмах, які він оцінив
+        users_preferences = self.preference_matrix[user_rows]
+        users_rated = users_preferences.copy()
+        users_rated.data = np.ones_like(users_rated.data)
+        films_similarity = self.similarity_matrix[film_cols]
+        weighted_sum = np.asarray(users_preferences.multiply(films_similarity).sum(axis=1)).ravel()
+        weights_sum = np.asarray(users_rated.multiply(films_similarity).sum(axis=1)).ravel()
+        user_delta = np.divide(weighted_sum, weights_sum, out=np.zeros(len(weighted_sum)), where=weights_sum != 0)
+        return self.mean_users_rating.to_numpy()[user_rows] + user_delta
+
+    def _predicted_ratings(self, user_rows):
+        users_preferences = self.preference_matrix[user_rows]
+        users_rated = users_preferences.copy()
+        users_rated.data = np.ones_like(users_rated.data)
+        weighted_sum = (users_preferences @ self.similarity_matrix.T).toarray()
+        weights_sum = (users_rated @ self.similarity_matrix.T).toarray()
+        user_delta = np.divide(weighted_sum, weights_sum, out=np.zeros(weighted_sum.shape), where=weights_sum != 0)
+        predicted_rating = self.mean_users_rating.to_numpy()[user_rows, None] + user_delta
+        return exclude_watched(predicted_rating, users_preferences)
+
+
 class ContentBasedModel(BaseModel):
     def __init__(self):
         self.model_name = 'content_based'
+        self.training_data = None
         self.rating_df = None
         self.encoded_movies = None
         self.index = None
 
     def fit(self, movies_df, rating_df):
+        self.training_data = model_store.training_data_summary(rating_df)
         self.rating_df = rating_df
         encoded_movies_df = pd.concat([movies_df.iloc[:, 0], pd.to_datetime(movies_df.iloc[:, 2], format='%d-%b-%Y'),
                                        movies_df.iloc[:, 4:].astype(int)], axis=1)
@@ -135,78 +637,212 @@ class ContentBasedModel(BaseModel):
         self.index.build(10)  # 10 trees
 
     def top_n(self, user_id, n=10):
-        watched_movies = self.encoded_movies.merge(
-            self.rating_df[self.rating_df.user_id == user_id][['item_id', 'rating']],
-            how='inner', on='item_id')
-        print(watched_movies.head())
-        number_watched_movies = len(watched_movies)
-        weights = watched_movies['rating'] / watched_movies.rating.sum()
-        watched_movies.drop(['rating', 'item_id'], axis=1, inplace=True)
-        mean_user_vector = watched_movies.mul(pd.Series(weights), axis=0).mean().to_list()
-        ttl_recs = zip(
-            self.index.get_nns_by_vector(mean_user_vector, number_watched_movies + n, include_distances=True)[0],
-            self.index.get_nns_by_vector(mean_user_vector, number_watched_movies + n, include_distances=True)[1])
-        recs_matrix = [[movie, distance] for movie, distance in ttl_recs if
-                       movie not in self.rating_df[self.rating_df.user_id == user_id]['item_id']][:n]
-        top_n = pd.DataFrame(recs_matrix, columns=['item_id', 'distance'])
-        return top_n
-
-    def save_model(self):
-        self.index.save(f'models/{self.model_name}_index.ann')
-        self.index = None
-        super().save_model()
+        return self.top_n_batch([user_id], n)[0]
+
+    def top_n_batch(self, users, n=10):
+        # вектори користувачів (зважене оцінками середнє векторів переглянутих фільмів) рахуються
+        # одним розрідженим множенням, пошук сусідів в annoy - для кожного користувача окремо
+        users = np.asarray(users)
+        users_ratings = self.rating_df[self.rating_df['user_id'].isin(users)]
+        watched_movies = users_ratings[users_ratings['item_id'].isin(self.encoded_movies.index)]
+        users_index = pd.Index(np.unique(watched_movies['user_id']))
+        user_rows = users_index.get_indexer(watched_movies['user_id'])
+        film_cols = self.encoded_movies.index.get_indexer(watched_movies['item_id'])
+        weights = sp.csr_matrix((watched_movies['rating'].to_numpy(dtype=float), (user_rows, film_cols)),
+                                shape=(len(users_index), len(self.encoded_movies)))
+        number_watched_movies = np.bincount(user_rows, minlength=len(users_index))
+        ratings_sum = np.asarray(weights.sum(axis=1)).ravel()
+        mean_users_vectors = (weights @ self.encoded_movies.to_numpy(dtype=float)) / \
+            (ratings_sum * number_watched_movies)[:, None]
+        users_watched = users_ratings.groupby('user_id')['item_id'].agg(set)
+
+        recs = [None] * len(users)
+        for position, row in enumerate(users_index.get_indexer(users)):
+            if row < 0:
+                continue
+            watched = users_watched.loc[users_index[row]]
+            movies, distances = self.index.get_nns_by_vector(mean_users_vectors[row].tolist(),
+                                                             int(number_watched_movies[row]) + n,
+                                                             include_distances=True)
+            recs_matrix = [[movie, distance] for movie, distance in zip(movies, distances)
+                           if movie not in watched][:n]
+            recs[position] = pd.DataFrame(recs_matrix, columns=['item_id', 'distance'])
+        return recs
 
 
 class MatrixFactorizationModel(BaseModel):
     def __init__(self):
         self.model_name = 'matrix_factorization'
-        self.train_rating_matrix = None
-        self.test_rating_matrix = None
-        self.prediction_matrix = None
-        self.train_mean_users_rating = None
-        self.test_mean_users_rating = None
+        self.training_data = None
+        self.method_to_fill_na = None
+        self.user_ids = None
+        self.item_ids = None
+        self.rating_matrix = None
+        self.watched_matrix = None
+        self.mean_users_rating = None
+        self.mean_items_rating = None
+        self.user_factors = None
         self.model = None
 
     def fit(self, train_df, method_to_fill_na='zeros', num_latent_features=2):
-        self.train_rating_matrix = pd.pivot_table(train_df, values='rating', index='user_id', columns=['item_id'])
-        self.train_mean_users_rating = self.train_rating_matrix.mean(axis=1)
-
-        if method_to_fill_na == 'zeros':
-            self.train_rating_matrix.fillna(0, inplace=True)
-        elif method_to_fill_na == 'average':
-            for row in self.train_rating_matrix.index:
-                self.train_rating_matrix.loc[row].fillna(self.train_mean_users_rating[row], axis=0, inplace=True)
-        else:
-            print('No such method: only zeros or average')
+        if method_to_fill_na not in ('zeros', 'average'):
+            raise ValueError('No such method: only zeros or average')
+        self.method_to_fill_na = method_to_fill_na
+        self.training_data = model_store.training_data_summary(train_df)
+
+        train_rating_matrix = pd.pivot_table(train_df, values='rating', index='user_id', columns=['item_id'])
+        self.user_ids = train_rating_matrix.index
+        self.item_ids = train_rating_matrix.columns
+        self.mean_users_rating = train_rating_matrix.mean(axis=1)
+        self.mean_items_rating = train_rating_matrix.mean(axis=0).to_numpy()
+        # оцінки зберігаються для fold_in: нові оцінки відомого користувача додаються до його історії
+        self.rating_matrix = sp.csr_matrix(train_rating_matrix.fillna(0).to_numpy())
+        self.watched_matrix = sp.csr_matrix(train_rating_matrix.notnull().to_numpy())
 
         self.model = NMF(n_components=num_latent_features, init='nndsvda', random_state=0)
+        self.user_factors = self.model.fit_transform(self._fill_na(train_rating_matrix))
 
-        self.model.fit(self.train_rating_matrix)
+    def _fill_na(self, rating_matrix):
+        values = rating_matrix.to_numpy(dtype=float, copy=True)
+        missing = np.isnan(values)
+        if self.method_to_fill_na == 'zeros':
+            values[missing] = 0
+        else:
+            values[missing] = np.broadcast_to(np.nanmean(values, axis=1)[:, None], values.shape)[missing]
+        return values
+
+    def fold_in(self, rating_df):
+        # вектори користувачів рахуються через transform при зафіксованих векторах фільмів (без перенавчання);
+        # для відомого користувача rating_df - лише нові оцінки: вони додаються до збережених
+        # (оцінка вже оціненого фільму замінюється), і вектор, середня та переглянуті фільми рахуються
+        # по всій історії; моделі, збережені без rating_matrix, відомих користувачів не приймають
+        rating_df = rating_df[rating_df['item_id'].isin(self.item_ids)]
+        if rating_df.empty:
+            # лише невідомі моделі фільми: векторів, які можна перерахувати, немає
+            return
+        rating_matrix = pd.pivot_table(rating_df, values='rating', index='user_id', columns=['item_id']) \
+            .reindex(columns=self.item_ids)
+        user_rows = self.user_ids.get_indexer(rating_matrix.index)
+        known = user_rows >= 0
+        ratings = rating_matrix.to_numpy(dtype=float, copy=True)
+        if known.any():
+            if getattr(self, 'rating_matrix', None) is None:
+                raise ValueError('Model was saved without ratings: retrain it to fold in known users')
+            stored_ratings = self.rating_matrix[user_rows[known]].toarray()
+            stored_ratings[stored_ratings == 0] = np.nan
+            ratings[known] = np.where(np.isnan(ratings[known]), stored_ratings, ratings[known])
+            rating_matrix = pd.DataFrame(ratings, index=rating_matrix.index, columns=rating_matrix.columns)
+        users_factors = self.model.transform(self._fill_na(rating_matrix))
+        users_mean = rating_matrix.mean(axis=1)
+
+        self.user_factors[user_rows[known]] = users_factors[known]
+        self.mean_users_rating.iloc[user_rows[known]] = users_mean[known].to_numpy()
+        users_ratings = sp.csr_matrix(np.nan_to_num(ratings))
+        watched = sp.csr_matrix(rating_matrix.notnull().to_numpy())
+        if known.any():
+            self.rating_matrix = self.rating_matrix.tolil()
+            self.rating_matrix[user_rows[known]] = users_ratings[np.flatnonzero(known)]
+            self.rating_matrix = self.rating_matrix.tocsr()
+            self.watched_matrix = self.watched_matrix.tolil()
+            self.watched_matrix[user_rows[known]] = watched[np.flatnonzero(known)]
+            self.watched_matrix = self.watched_matrix.tocsr()
+        if (~known).any():
+            self.user_ids = self.user_ids.append(rating_matrix.index[~known])
+            self.user_factors = np.vstack([self.user_factors, users_factors[~known]])
+            self.mean_users_rating = pd.concat([self.mean_users_rating, users_mean[~known]])
+            if getattr(self, 'rating_matrix', None) is not None:
+                self.rating_matrix = sp.vstack([self.rating_matrix, users_ratings[np.flatnonzero(~known)]],
+                                               format='csr')
+            self.watched_matrix = sp.vstack([self.watched_matrix, watched[np.flatnonzero(~known)]], format='csr')
+
+    def _predict_pairs(self, user_rows, film_cols):
+        return np.einsum('ij,ji->i', self.user_factors[user_rows], self.model.components_[:, film_cols])
+
+    def _predicted_ratings(self, user_rows):
+        predicted_rating = self.user_factors[user_rows] @ self.model.components_
+        return exclude_watched(predicted_rating, self.watched_matrix[user_rows])
+
+
+class AlternatingLeastSquaresModel(BaseModel):
+    # ALS прямо по розрідженій матриці оцінок:
+    # explicit - відхилення оцінок від середньої, регуляризація пропорційна кількості оцінок (ALS-WR);
+    # implicit - впевненість 1 + alpha * rating для переглянутих фільмів (Hu, Koren, Volinsky)
+    def __init__(self):
+        self.model_name = 'alternating_least_squares'
+        self.training_data = None
+        self.implicit = False
+        self.user_ids = None
+        self.item_ids = None
+        self.rating_matrix = None
+        self.global_mean = None
+        self.mean_users_rating = None
+        self.mean_items_rating = None
+        self.user_factors = None
+        self.item_factors = None
+
+    def fit(self, train_df, factors=20, regularization=0.1, iterations=15, implicit=False, alpha=40.0,
+            n_threads=None, block_size=4096, random_state=0):
+        self.implicit = implicit
+        self.training_data = model_store.training_data_summary(train_df)
+        self.rating_matrix, self.user_ids, self.item_ids = sparse_rating_matrix(train_df)
+        ratings = self.rating_matrix.tocsc()
+        self.global_mean = self.rating_matrix.data.mean()
+        self.mean_users_rating = pd.Series(np.asarray(self.rating_matrix.sum(axis=1)).ravel() /
+                                           np.maximum(np.diff(self.rating_matrix.indptr), 1), index=self.user_ids)
+        self.mean_items_rating = np.asarray(ratings.sum(axis=0)).ravel() / np.maximum(np.diff(ratings.indptr), 1)
+
+        if implicit:
+            users_items = self.rating_matrix.copy()
+            users_items.data = alpha * users_items.data
+        else:
+            users_items = self.rating_matrix.copy()
+            users_items.data = users_items.data - self.global_mean
+        items_users = users_items.T.tocsr()
+
+        rng = np.random.default_rng(random_state)
+        self.user_factors = rng.normal(0, 0.01, (len(self.user_ids), factors))
+        self.item_factors = rng.normal(0, 0.01, (len(self.item_ids), factors))
+        with ThreadPoolExecutor(max_workers=n_threads or os.cpu_count()) as executor:
+            for _ in range(iterations):
+                self.user_factors = self._solve(users_items, self.item_factors, regularization, block_size, executor)
+                self.item_factors = self._solve(items_users, self.user_factors, regularization, block_size, executor)
+
+    def _solve(self, ratings, fixed_factors, regularization, block_size, executor):
+        # нові вектори для всіх рядків ratings при зафіксованих fixed_factors;
+        # рядки діляться на блоки, блоки розв'язуються паралельно в потоках
+        factors = fixed_factors.shape[1]
+        outer_products = (fixed_factors[:, :, None] * fixed_factors[:, None, :]).reshape(len(fixed_factors), -1)
+        gram_matrix = fixed_factors.T @ fixed_factors
+        identity = np.eye(factors)
+
+        def solve_block(start):
+            block = ratings[start:start + block_size]
+            counts = np.diff(block.indptr)
+            weights = block.copy()
+            if self.implicit:
+                # A = Y^T Y + Y^T (C - I) Y + lambda * I, b = Y^T C p
+                a = gram_matrix + (weights @ outer_products).reshape(-1, factors, factors)
+                a += regularization * identity
+                weights.data = weights.data + 1
+                b = weights @ fixed_factors
+            else:
+                weights.data = np.ones_like(weights.data)
+                a = (weights @ outer_products).reshape(-1, factors, factors)
+                a += regularization * np.maximum(counts, 1)[:, None, None] * identity
+                b = block @ fixed_factors
+            return np.linalg.solve(a, b[..., None])[..., 0]
+
+        return np.vstack(list(executor.map(solve_block, range(0, ratings.shape[0], block_size))))
+
+    def _predict_pairs(self, user_rows, film_cols):
+        # в implicit-режимі для відомих пар повертається оцінка вподобання, а не рейтинг
+        rating_prediction = np.einsum('ij,ij->i', self.user_factors[user_rows], self.item_factors[film_cols])
+        if not self.implicit:
+            rating_prediction += self.global_mean
+        return rating_prediction
 
-    def predict(self, test_df):
-        # delete new users and films
-        user_filter = test_df['user_id'].isin(self.train_rating_matrix.index)
-        item_filter = test_df['item_id'].isin(self.train_rating_matrix.columns)
-        test_df_without_new = test_df[user_filter & item_filter]
-        # data preparation
-        self.test_rating_matrix = pd.pivot_table(test_df_without_new, values='rating',
-                                                 index='user_id', columns=['item_id'])
-        self.test_mean_users_rating = self.test_rating_matrix.mean(axis=1)
-        for row in self.test_rating_matrix.index:
-            self.test_rating_matrix.loc[row].fillna(self.test_mean_users_rating[row], axis=0, inplace=True)
-        #
-        users = self.model.fit_transform(self.test_rating_matrix)
-        movies = self.model.components_
-        self.prediction_matrix = np.dot(users, movies)
-
-        # if user in self.rating_matrix.index and film in self.rating_matrix.columns:
-        #
-        #     # print('all info known')
-        # elif film in self.rating_matrix.columns:
-        #     rating_prediction = self.rating_matrix.loc[:, film].mean()
-        #     # print('user unknown')
-        # else:
-        #     rating_prediction = self.mean_users_rating.loc[user]
-        #     # print('film unknown')
-
-        # return rating_prediction
+    def _predicted_ratings(self, user_rows):
+        predicted_rating = self.user_factors[user_rows] @ self.item_factors.T
+        if not self.implicit:
+            predicted_rating += self.global_mean
+        return exclude_watched(predicted_rating, self.rating_matrix[user_rows])
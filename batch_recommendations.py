@@ -0,0 +1,130 @@
+import argparse
+import os
+import pickle
+import time
+
+import numpy as np
+import pandas as pd
+
+import model_store
+from metrics import recommend_all
+
+RECOMMENDATIONS_PATH = 'models/recommendations'
+# колонка з оцінкою в результаті top_n кожної моделі
+SCORE_COLUMNS = {'content_based': 'distance'}
+
+
+def load_pickled_model(model_name, models_path='models'):
+    # моделі, збережені до переходу на артефакти model_store
+    model = pickle.load(open(f'{models_path}/{model_name}.pickle', 'rb'))
+    if model_name == 'content_based':
+        from annoy import AnnoyIndex
+        model.index = AnnoyIndex(20, 'angular')
+        model.index.load(f'{models_path}/{model_name}_index.ann')
+    return upgrade_pickled_model(model)
+
+
+def upgrade_pickled_model(model):
+    # pickle не викликає __init__, тож атрибутів, доданих у клас після збереження моделі, в ній немає:
+    # вони беруться зі значень за замовчуванням нового екземпляра (щільна CF, без індексу сусідів, без
+    # training_data), а id користувачів і фільмів старої CF - з індексу і колонок її rating_matrix
+    for name, value in type(model)().__dict__.items():
+        model.__dict__.setdefault(name, value)
+    if model.__dict__.get('user_ids', 0) is None and isinstance(model.__dict__.get('rating_matrix'), pd.DataFrame):
+        model.user_ids = model.rating_matrix.index
+        model.item_ids = model.rating_matrix.columns
+    return model
+
+
+def load_model(model_name, models_path='models'):
+    if model_store.exists(model_name):
+        return model_store.load(model_name)
+    return load_pickled_model(model_name, models_path)
+
+
+def model_users(model):
+    if getattr(model, 'user_ids', None) is not None:
+        return np.asarray(model.user_ids)
+    return np.sort(model.rating_df['user_id'].unique())
+
+
+def precompute(model, n=10, n_jobs=None, path=RECOMMENDATIONS_PATH):
+    # top_n для всіх користувачів моделі в пулі процесів, результат - компактний .npz з версією моделі:
+    # версія береться з маніфесту артефакту, і load_all звіряє її з версією завантаженої моделі
+    # (модель не з артефакту отримує лише мітку часу, і сервіс такий файл не використає)
+    users = model_users(model)
+    generated_at = int(time.time())
+    model_version = model_store.loaded_version(model)
+    recs, scores = recommend_all(model, users, n, n_jobs, with_scores=True)
+    os.makedirs(path, exist_ok=True)
+    file_path = os.path.join(path, f'{model.model_name}.npz')
+    np.savez(file_path, users=users, recs=recs.astype(np.int32), scores=scores,
+             model_name=model.model_name, model_version=model_version or f'{model.model_name}-{generated_at}',
+             score_column=SCORE_COLUMNS.get(model.model_name, 'predicted_rating'), generated_at=generated_at)
+    return file_path
+
+
+class PrecomputedRecommendations:
+    def __init__(self, users, recs, scores, model_name, model_version, score_column, generated_at):
+        self.users = pd.Index(users)
+        self.recs = recs
+        self.scores = scores
+        self.model_name = model_name
+        self.model_version = model_version
+        self.score_column = score_column
+        self.generated_at = generated_at
+        self.stale_users = set()
+
+    @classmethod
+    def load(cls, file_path):
+        data = np.load(file_path)
+        return cls(data['users'], data['recs'], data['scores'], str(data['model_name']), str(data['model_version']),
+                   str(data['score_column']), int(data['generated_at']))
+
+    def mark_stale_since_batch(self, get_connection):
+        # користувачі, що оцінювали фільми після генерації, рахуються наживо
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f'SELECT DISTINCT user_id FROM ratings WHERE timestamp >= {self.generated_at}')
+            self.stale_users.update(user_id for user_id, in cur.fetchall())
+            cur.close()
+
+    def mark_stale(self, user):
+        self.stale_users.add(user)
+
+    def top_n(self, user, n=10):
+        if user in self.stale_users or n > self.recs.shape[1] or user not in self.users:
+            return None
+        user_row = self.users.get_loc(user)
+        found = self.recs[user_row] >= 0
+        return pd.DataFrame({'item_id': self.recs[user_row][found][:n].astype(np.int64),
+                             self.score_column: self.scores[user_row][found][:n].astype(float)})
+
+
+def load_all(model_names, get_connection=None, path=RECOMMENDATIONS_PATH, model_versions=None):
+    # model_versions - версії завантажених моделей: рекомендації, пораховані іншою версією, не використовуються
+    precomputed = {}
+    for model_name in model_names:
+        file_path = os.path.join(path, f'{model_name}.npz')
+        if os.path.exists(file_path):
+            recommendations = PrecomputedRecommendations.load(file_path)
+            if model_versions is not None and recommendations.model_version != model_versions.get(model_name):
+                print(f'{model_name} precomputed recommendations skipped: generated by '
+                      f'{recommendations.model_version}, loaded model is {model_versions.get(model_name)}')
+                continue
+            precomputed[model_name] = recommendations
+            if get_connection is not None:
+                precomputed[model_name].mark_stale_since_batch(get_connection)
+            print(f'{model_name} precomputed recommendations loaded ({precomputed[model_name].model_version})')
+    return precomputed
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Precompute top-N recommendations for all users')
+    arg_parser.add_argument('--models', nargs='+', default=['collaborative_filtering', 'content_based'])
+    arg_parser.add_argument('--n', type=int, default=10)
+    arg_parser.add_argument('--jobs', type=int, default=None)
+    args = arg_parser.parse_args()
+    for name in args.models:
+        start = time.time()
+        print(precompute(load_model(name), args.n, args.jobs), f'{time.time() - start:.1f} s')
@@ -0,0 +1,160 @@
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import synthetic_data
+from train_test_split import train_test_split_indices
+
+# назва -> (клас моделі, параметри конструктора, параметри fit)
+MODELS = {
+    'cf': ('CollaborativeFilteringModel', {}, {}),
+    'cf_sparse': ('CollaborativeFilteringModel', {'sparse': True}, {}),
+    'cf_top_k': ('CollaborativeFilteringModel', {'sparse': True}, {'top_k': 50}),
+    'item_cf': ('ItemBasedCollaborativeFilteringModel', {}, {}),
+    'cb': ('ContentBasedModel', {}, {}),
+    'mf': ('MatrixFactorizationModel', {}, {}),
+    'als': ('AlternatingLeastSquaresModel', {}, {}),
+    'als_implicit': ('AlternatingLeastSquaresModel', {}, {'implicit': True}),
+}
+
+
+def peak_rss_mb():
+    # ru_maxrss у Linux - в кілобайтах, у macOS - в байтах
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / (1024 * 1024 if platform.system() == 'Darwin' else 1024)
+
+
+def latency_percentiles(durations):
+    durations_ms = np.asarray(durations) * 1000
+    return {'calls': len(durations_ms), 'p50_ms': float(np.percentile(durations_ms, 50)),
+            'p95_ms': float(np.percentile(durations_ms, 95)), 'p99_ms': float(np.percentile(durations_ms, 99)),
+            'max_ms': float(durations_ms.max())}
+
+
+def load_data(data_dir):
+    rating_df = pd.read_csv(os.path.join(data_dir, 'rating.csv')).drop(['Unnamed: 0'], axis=1)
+    movies_df = pd.read_csv(os.path.join(data_dir, 'movies.csv')).drop(['Unnamed: 0'], axis=1)
+    movies_df = movies_df.drop([266], axis=0)
+    return rating_df, movies_df
+
+
+def run_model(model_name, data_dir, calls=200, seed=0):
+    # запускається в окремому процесі, щоб пікова пам'ять рахувалась для кожної моделі окремо
+    import base_model
+
+    class_name, init_kwargs, fit_kwargs = MODELS[model_name]
+    rating_df, movies_df = load_data(data_dir)
+    train_idx, test_idx = train_test_split_indices(rating_df, 'timestamp', 0.8)
+    train_df = rating_df.iloc[train_idx].reset_index(drop=True)
+    test_df = rating_df.iloc[test_idx].reset_index(drop=True)
+    rng = np.random.default_rng(seed)
+
+    result = {'model': model_name, 'ratings': len(rating_df), 'train_ratings': len(train_df),
+              'rss_before_fit_mb': peak_rss_mb()}
+    model = getattr(base_model, class_name)(**init_kwargs)
+    start = time.perf_counter()
+    if class_name == 'ContentBasedModel':
+        model.fit(movies_df, train_df, **fit_kwargs)
+    else:
+        model.fit(train_df, **fit_kwargs)
+    result['fit_s'] = time.perf_counter() - start
+    result['peak_rss_mb'] = peak_rss_mb()
+
+    sample = test_df.iloc[rng.integers(0, len(test_df), calls)]
+    users = rng.choice(train_df['user_id'].unique(), calls)
+    with contextlib.redirect_stdout(io.StringIO()):
+        if class_name != 'ContentBasedModel':
+            durations = []
+            for user, film in zip(sample['user_id'], sample['item_id']):
+                start = time.perf_counter()
+                model.predict_one(user, film)
+                durations.append(time.perf_counter() - start)
+            result['predict_one'] = latency_percentiles(durations)
+
+        if hasattr(model, 'top_n'):
+            durations = []
+            for user in users:
+                start = time.perf_counter()
+                model.top_n(user, 10)
+                durations.append(time.perf_counter() - start)
+            result['top_n'] = latency_percentiles(durations)
+
+        if class_name != 'ContentBasedModel':
+            start = time.perf_counter()
+            model.predict(test_df)
+            duration = time.perf_counter() - start
+            result['batch_predict'] = {'rows': len(test_df), 'seconds': duration,
+                                       'rows_per_s': len(test_df) / duration}
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def run_isolated(model_name, data_dir, calls, seed):
+    # якщо процес моделі вбито (напр. OOM killer на щільній CF для великих масштабів), пул не чекає вічно,
+    # а кидає BrokenProcessPool, і модель записується в результати з помилкою
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        try:
+            return executor.submit(run_model, model_name, data_dir, calls, seed).result()
+        except BrokenProcessPool:
+            raise RuntimeError('benchmark process died (killed or out of memory)')
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_report(report, output):
+    # звіт переписується після кожної моделі: результати вже пройдених моделей не губляться, якщо запуск перервано
+    tmp_path = output + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_path, output)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmark recommender models on synthetic data')
+    arg_parser.add_argument('--scales', nargs='+', default=['100k'], choices=list(synthetic_data.SCALES))
+    arg_parser.add_argument('--models', nargs='+', default=list(MODELS), choices=list(MODELS))
+    arg_parser.add_argument('--data-dir', default='data/synthetic')
+    arg_parser.add_argument('--calls', type=int, default=200)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--output', default='benchmark_results.json')
+    args = arg_parser.parse_args()
+
+    report = {'created_at': datetime.now().isoformat(timespec='seconds'), 'git_revision': git_revision(),
+              'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+              'cpu_count': os.cpu_count(), 'results': []}
+    for scale in args.scales:
+        data_dir = os.path.join(args.data_dir, scale)
+        if not os.path.exists(os.path.join(data_dir, 'rating.csv')):
+            print(f'generating {scale} dataset in {data_dir}')
+            synthetic_data.generate(scale, data_dir, args.seed)
+        for model_name in args.models:
+            try:
+                result = run_isolated(model_name, data_dir, args.calls, args.seed)
+            except Exception as e:
+                result = {'model': model_name, 'error': repr(e)}
+            result['scale'] = scale
+            report['results'].append(result)
+            print(json.dumps(result))
+            write_report(report, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from base_model import top_n_scores
+from db import PLACEHOLDER
+
+# вікові групи як у MovieLens: до 18, 18-24, 25-34, 35-44, 45-49, 50-55, 56+
+AGE_BINS = [18, 25, 35, 45, 50, 56]
+SEGMENT_FIELDS = ('age', 'gender', 'occupation', 'region')
+# рівні сегментів від найвужчого до найширшого: користувач отримує рейтинг першого з його сегментів,
+# у якому достатньо людей; () - усі користувачі
+SEGMENT_LEVELS = [('age', 'gender', 'occupation'), ('age', 'gender', 'region'), ('age', 'gender'), ('gender',), ()]
+
+
+def user_segment(age, gender, occupation, zip_code):
+    # region - перша цифра поштового індексу
+    age_group = int(np.digitize(age, AGE_BINS)) if age is not None and not pd.isna(age) else None
+    region = str(zip_code)[:1] if zip_code is not None and not pd.isna(zip_code) and str(zip_code) else None
+    return age_group, gender, occupation, region
+
+
+def segment_keys(segment):
+    values = dict(zip(SEGMENT_FIELDS, segment))
+    return [(level, tuple(values[field] for field in level)) for level in SEGMENT_LEVELS]
+
+
+class DemographicRecommender:
+    # холодний старт: для кожного демографічного сегменту - size найкращих фільмів за зваженою середньою оцінкою:
+    # середня оцінка фільму в сегменті зсувається до його середньої серед усіх на prior_weight оцінок,
+    # а та - до середньої оцінки взагалі, тож популярний і добре оцінений фільм обганяє фільм з кількома п'ятірками;
+    # рейтинги перераховуються повністю раз на refresh_interval секунд, а нові оцінки додаються в лічильники
+    # сегментів користувача і змінені сегменти переранжуються раз на update_interval секунд
+    model_name = 'demographic'
+
+    def __init__(self, get_connection, size=100, prior_weight=20, min_segment_users=30, refresh_interval=3600,
+                 update_interval=10):
+        self.get_connection = get_connection
+        self.size = size
+        self.prior_weight = prior_weight
+        self.min_segment_users = min_segment_users
+        self.refresh_interval = refresh_interval
+        self.update_interval = update_interval
+        self.refreshed_at = None
+        self.max_timestamp = None
+        self.item_ids = None
+        self._stats = {}
+        self._rankings = None
+        self._user_segments = {}
+        self._new_ratings = deque()
+        self._refresh_lock = threading.Lock()
+        self._thread = None
+
+    def refresh(self):
+        with self._refresh_lock:
+            with self.get_connection() as conn:
+                cur = conn.cursor()
+                cur.execute('SELECT user_id, age, gender, occupation, zip_code FROM users')
+                users = cur.fetchall()
+                cur.execute('SELECT user_id, item_id, rating, timestamp FROM ratings')
+                rating_df = pd.DataFrame(cur.fetchall(), columns=['user_id', 'item_id', 'rating', 'timestamp'])
+                cur.close()
+
+            user_segments = {user: user_segment(age, gender, occupation, zip_code)
+                             for user, age, gender, occupation, zip_code in users}
+            users_df = pd.DataFrame(list(user_segments.values()), index=list(user_segments), columns=SEGMENT_FIELDS)
+            rated_df = rating_df.join(users_df, on='user_id', how='inner')
+            item_ids = pd.Index(np.sort(rating_df['item_id'].unique()))
+            films = item_ids.get_indexer(rated_df['item_id'])
+            ratings = rated_df['rating'].to_numpy(dtype=float)
+
+            stats = {}
+            segment_users = {}
+            for level in SEGMENT_LEVELS:
+                if level:
+                    groups = rated_df.groupby(list(level), sort=False).indices
+                    sizes = users_df.groupby(list(level)).size()
+                else:
+                    groups = {(): np.arange(len(rated_df))}
+                    sizes = {(): len(users_df)}
+                for values, rows in groups.items():
+                    key = (level, values if isinstance(values, tuple) else (values,))
+                    stats[key] = (np.bincount(films[rows], minlength=len(item_ids)).astype(np.float32),
+                                  np.bincount(films[rows], ratings[rows], minlength=len(item_ids)).astype(np.float32))
+                for values, size in sizes.items():
+                    segment_users[(level, values if isinstance(values, tuple) else (values,))] = size
+
+            self.item_ids = item_ids
+            self._stats = stats
+            self._user_segments = user_segments
+            self.max_timestamp = rating_df['timestamp'].max() if len(rating_df) else None
+            prior = self._prior()
+            self._rankings = {key: self._rank(key, prior) for key in stats
+                              if not key[0] or segment_users.get(key, 0) >= self.min_segment_users}
+            self.refreshed_at = time.time()
+
+    def _prior(self):
+        # середня оцінка кожного фільму серед усіх користувачів, зсунута до загальної середньої
+        counts, sums = self._stats.get(((), ()), (None, None))
+        if counts is None:
+            return None
+        global_mean = sums.sum() / max(counts.sum(), 1)
+        return (sums + self.prior_weight * global_mean) / (counts + self.prior_weight)
+
+    def _rank(self, key, prior):
+        counts, sums = self._stats[key]
+        scores = (sums + self.prior_weight * prior) / (counts + self.prior_weight)
+        top, top_scores = top_n_scores(scores[np.newaxis], self.size)
+        return self.item_ids[top[0]].to_numpy(), top_scores[0]
+
+    def segment(self, user):
+        # демографія нових користувачів (зареєстрованих після refresh) читається з БД один раз
+        if user is None:
+            return None
+        segment = self._user_segments.get(user)
+        if segment is None:
+            with self.get_connection() as conn:
+                cur = conn.cursor()
+                cur.execute(f'SELECT age, gender, occupation, zip_code FROM users WHERE user_id = {PLACEHOLDER}',
+                            [user])
+                row = cur.fetchone()
+                cur.close()
+            if row is None:
+                return None
+            segment = self._user_segments[user] = user_segment(*row)
+        return segment
+
+    def top_n(self, user, n=10):
+        # кілька пошуків у dict; None - користувача немає в таблиці users
+        if self._rankings is None:
+            self.refresh()
+        segment = self.segment(user)
+        if segment is None:
+            return None
+        for key in segment_keys(segment):
+            ranking = self._rankings.get(key)
+            if ranking is not None:
+                item_ids, scores = ranking
+                return pd.DataFrame({'item_id': item_ids[:n], 'score': scores[:n]})
+        return pd.DataFrame(columns=['item_id', 'score'])
+
+    def rating_added(self, user, film, rating, timestamp):
+        self._new_ratings.append((user, film, rating, timestamp))
+
+    def update(self):
+        # нові оцінки додаються в лічильники всіх сегментів користувача; оцінки, що вже є в знімку
+        # останнього refresh, і фільми, яких у ньому немає, пропускаються до наступного refresh
+        with self._refresh_lock:
+            changed = set()
+            while self._new_ratings:
+                user, film, rating, timestamp = self._new_ratings.popleft()
+                if self.max_timestamp is not None and timestamp <= self.max_timestamp:
+                    continue
+                segment = self.segment(user)
+                if segment is None or film not in self.item_ids:
+                    continue
+                film_col = self.item_ids.get_loc(film)
+                for key in segment_keys(segment):
+                    if key in self._stats:
+                        counts, sums = self._stats[key]
+                        counts[film_col] += 1
+                        sums[film_col] += rating
+                        changed.add(key)
+            if not changed:
+                return 0
+            prior = self._prior()
+            # зміна загальних лічильників зсуває prior для всіх сегментів, але переранжуються лише змінені
+            for key in changed:
+                if key in self._rankings:
+                    self._rankings[key] = self._rank(key, prior)
+            return len(changed)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='demographic-recommender', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                if self.refreshed_at is None or time.time() - self.refreshed_at >= self.refresh_interval:
+                    self.refresh()
+                else:
+                    self.update()
+            except Exception as e:
+                print('demographic recommender refresh failed:', e)
+            time.sleep(self.update_interval)
@@ -0,0 +1,186 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from instrumentation import stage_timer
+
+DB_ENGINE = os.environ.get('RECSYS_DB_ENGINE', 'postgres')  # postgres або sqlite
+POSTGRES_CONFIG = {
+    'host': os.environ.get('RECSYS_DB_HOST', 'localhost'),
+    'database': os.environ.get('RECSYS_DB_NAME', 'RecSys'),
+    'user': os.environ.get('RECSYS_DB_USER', 'postgres'),
+    'password': os.environ.get('RECSYS_DB_PASSWORD', '087539'),
+}
+SQLITE_PATH = os.environ.get('RECSYS_SQLITE_PATH', 'data/recsys.sqlite3')
+POOL_MIN_SIZE = int(os.environ.get('RECSYS_DB_POOL_MIN', 1))
+POOL_MAX_SIZE = int(os.environ.get('RECSYS_DB_POOL_MAX', 10))
+# плейсхолдер параметрів запиту: psycopg2 - %s, sqlite3 - ?
+PLACEHOLDER = '?' if DB_ENGINE == 'sqlite' else '%s'
+
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (user_id INTEGER, age INTEGER, gender TEXT, occupation TEXT, zip_code TEXT);
+CREATE TABLE IF NOT EXISTS ratings (user_id INTEGER, item_id INTEGER, rating INTEGER, timestamp INTEGER);
+CREATE TABLE IF NOT EXISTS wishlist (user_id INTEGER, item_id INTEGER, datetime DATE, from_recommendations BOOLEAN);
+CREATE TABLE IF NOT EXISTS full_movies (item_id INTEGER, title TEXT, release_date TEXT, imdb_url TEXT, title_ua TEXT,
+                                        imdb_url_new TEXT, poster_url TEXT);
+'''
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    # пул з'єднань: від min_size до max_size відкритих з'єднань, з перевіркою
+    # з'єднань, що простоювали довше за check_interval секунд
+    def __init__(self, connect, min_size=1, max_size=10, check_interval=30, timeout=10):
+        self._connect = connect
+        self.max_size = max_size
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        for _ in range(min_size):
+            self._idle.put((connect(), time.monotonic()))
+
+    def getconn(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f'no free connection in {self.timeout} s (max_size={self.max_size})')
+        try:
+            while True:
+                try:
+                    conn, last_used = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if time.monotonic() - last_used < self.check_interval or self._is_healthy(conn):
+                    return conn
+                self._close(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn, close=False):
+        try:
+            if close or getattr(conn, 'closed', False):
+                self._close(conn)
+            else:
+                conn.rollback()
+                self._idle.put((conn, time.monotonic()))
+        except Exception:
+            self._close(conn)
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._close(conn)
+
+    @staticmethod
+    def _is_healthy(conn):
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.fetchall()
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+class TimedCursor:
+    # курсор, що записує тривалість кожного запиту в метрику db_query
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, *args, **kwargs):
+        with stage_timer('db_query'):
+            return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        with stage_timer('db_query'):
+            return self._cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class PooledConnection:
+    # обгортка, у якої close() повертає з'єднання в пул замість закриття
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = pool.getconn()
+
+    def cursor(self):
+        return TimedCursor(self._conn.cursor())
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.putconn(self._conn)
+            self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def connect_postgres():
+    import psycopg2
+    return psycopg2.connect(**POSTGRES_CONFIG)
+
+
+def connect_sqlite(path=None):
+    path = path or SQLITE_PATH
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.executescript(SQLITE_SCHEMA)
+    return conn
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                connect = connect_sqlite if DB_ENGINE == 'sqlite' else connect_postgres
+                _pool = ConnectionPool(connect, POOL_MIN_SIZE, POOL_MAX_SIZE)
+    return _pool
+
+
+def close_pool():
+    # перед fork: з'єднання не можна ділити між процесами, кожен воркер відкриє власний пул
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+def get_db_connection():
+    return PooledConnection(get_pool())
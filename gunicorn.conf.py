@@ -0,0 +1,39 @@
+import multiprocessing
+import os
+import shutil
+
+# gunicorn -c gunicorn.conf.py app:app
+# app.py імпортується один раз у майстер-процесі (масиви моделей відображаються в пам'ять з models/artifacts),
+# воркери створюються fork і ділять ті самі сторінки пам'яті (copy-on-write)
+os.environ['RECSYS_PRELOAD'] = '1'
+preload_app = True
+bind = os.environ.get('RECSYS_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('RECSYS_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.environ.get('RECSYS_THREADS', 4))
+timeout = 120
+# метрики всіх воркерів: prometheus_client пише їх у файли цього каталогу, тому змінна має бути задана
+# до імпорту app; файли попереднього запуску видаляються
+PROMETHEUS_MULTIPROC_DIR = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', 'data/prometheus')
+shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+os.makedirs(PROMETHEUS_MULTIPROC_DIR)
+
+
+def pre_fork(server, worker):
+    import db
+    db.close_pool()
+
+
+def post_fork(server, worker):
+    import app
+    app.start_worker()
+
+
+def worker_exit(server, worker):
+    # записати в БД оцінки і зміни списку бажань, що ще лишились у буфері воркера
+    import app
+    app.stop_worker()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,79 @@
+import os
+import time
+from contextlib import contextmanager
+
+import flask
+from flask import g, request, Response
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, \
+    generate_latest, multiprocess
+
+REQUEST_LATENCY = Histogram('recsys_request_seconds', 'Request latency by route',
+                            ['route', 'method', 'status'])
+STAGE_LATENCY = Histogram('recsys_stage_seconds', 'Latency of request stages: db queries, model calls, rendering',
+                          ['stage'], buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+# multiprocess_mode - як gunicorn-режим (PROMETHEUS_MULTIPROC_DIR) зводить значення воркерів в одне
+MODEL_LOAD_SECONDS = Gauge('recsys_model_load_seconds', 'Duration of model load or fit at startup',
+                           ['model', 'action'], multiprocess_mode='max')
+MODEL_STALE = Gauge('recsys_model_stale', 'Model artifact is older than the ratings it should be trained on',
+                    ['model'], multiprocess_mode='max')
+CACHE_LOOKUPS = Counter('recsys_recommendations_cache_lookups', 'Recommendation cache lookups', ['result'])
+
+
+@contextmanager
+def stage_timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.labels(stage).observe(time.perf_counter() - start)
+
+
+@contextmanager
+def model_load_timer(model, action):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        MODEL_LOAD_SECONDS.labels(model, action).set(time.perf_counter() - start)
+
+
+def model_stale(model, stale):
+    MODEL_STALE.labels(model).set(int(stale))
+
+
+def render_template(template_name, **context):
+    with stage_timer('render_template'):
+        return flask.render_template(template_name, **context)
+
+
+def cache_lookup(hit):
+    CACHE_LOOKUPS.labels('hit' if hit else 'miss').inc()
+
+
+def _start_timer():
+    g.request_start = time.perf_counter()
+
+
+def _observe_request(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        # шаблон маршруту, а не фактичний шлях, щоб кількість рядів метрики не росла
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        REQUEST_LATENCY.labels(route, request.method, response.status_code).observe(time.perf_counter() - start)
+    return response
+
+
+def metrics():
+    # з кількома воркерами gunicorn кожен пише метрики у файли PROMETHEUS_MULTIPROC_DIR (gunicorn.conf.py),
+    # і /metrics, хоч який воркер його обслуговує, збирає їх усі
+    registry = REGISTRY
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+def init_app(app):
+    app.before_request(_start_timer)
+    app.after_request(_observe_request)
+    app.add_url_rule('/metrics', 'metrics', metrics)
@@ -0,0 +1,97 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+_worker_model = None
+
+
+def _init_worker(model):
+    global _worker_model
+    _worker_model = model
+
+
+def _top_n_shard(users, k):
+    recs = np.full((len(users), k), -1, dtype=np.int64)
+    scores = np.full((len(users), k), np.nan, dtype=np.float32)
+    if hasattr(_worker_model, 'top_n_batch'):
+        top_ns = _worker_model.top_n_batch(users, k)
+    else:
+        # моделі, що мають лише top_n, - по одному користувачу
+        top_ns = (_worker_model.top_n(user, k) for user in users)
+    for i, top_n in enumerate(top_ns):
+        if top_n is None:
+            continue
+        top_n = top_n.head(k)
+        recs[i, :len(top_n)] = top_n['item_id'].to_numpy()
+        scores[i, :len(top_n)] = top_n.drop(['item_id'], axis=1).iloc[:, 0].to_numpy()
+    return recs, scores
+
+
+def recommend_all(model, users, k=10, n_jobs=None, with_scores=False):
+    # top_n для всіх користувачів; користувачі діляться на n_jobs частин, кожна рахується в окремому процесі
+    users = np.asarray(users)
+    n_jobs = n_jobs or os.cpu_count()
+    if n_jobs == 1 or len(users) < 2 * n_jobs:
+        _init_worker(model)
+        recs, scores = _top_n_shard(users, k)
+    else:
+        shards = np.array_split(users, n_jobs)
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(model,)) as executor:
+            results = list(executor.map(_top_n_shard, shards, [k] * len(shards)))
+        recs = np.vstack([shard_recs for shard_recs, _ in results])
+        scores = np.vstack([shard_scores for _, shard_scores in results])
+    return (recs, scores) if with_scores else recs
+
+
+def relevant_pairs(test_df, train_df=None):
+    # як у main.py: фільм релевантний, якщо оцінка не нижча за середню оцінку користувача
+    rating_df = test_df if train_df is None else pd.concat([train_df, test_df])
+    mean_users_rating = rating_df.groupby('user_id')['rating'].mean()
+    relevant = test_df['rating'].to_numpy() >= mean_users_rating.loc[test_df['user_id']].to_numpy()
+    return test_df.loc[relevant, ['user_id', 'item_id']]
+
+
+def ranking_metrics(users, recs, relevant_df, catalogue_size):
+    # precision@k, recall@k, NDCG@k, MAP@k для всіх користувачів одразу над матрицею рекомендацій users x k
+    users = pd.Index(users)
+    k = recs.shape[1]
+    relevant_df = relevant_df[relevant_df['user_id'].isin(users)]
+    relevant_rows = users.get_indexer(relevant_df['user_id'])
+    relevant_count = np.bincount(relevant_rows, minlength=len(users))
+
+    items_count = max(recs.max(), relevant_df['item_id'].max() if len(relevant_df) else 0) + 1
+    relevant_keys = relevant_rows.astype(np.int64) * items_count + relevant_df['item_id'].to_numpy()
+    recs_keys = np.arange(len(users))[:, None] * items_count + recs
+    hits = np.isin(recs_keys, relevant_keys) & (recs >= 0)
+
+    discounts = 1 / np.log2(np.arange(2, k + 2))
+    ideal_dcg = np.concatenate([[0], np.cumsum(discounts)])[np.minimum(relevant_count, k)]
+    precision_at_rank = np.cumsum(hits, axis=1) / np.arange(1, k + 1)
+
+    per_user = pd.DataFrame({
+        'user_id': users,
+        'precision': hits.sum(axis=1) / k,
+        'recall': hits.sum(axis=1) / np.maximum(relevant_count, 1),
+        'ndcg': (hits * discounts).sum(axis=1) / np.where(ideal_dcg > 0, ideal_dcg, 1),
+        'ap': (precision_at_rank * hits).sum(axis=1) / np.maximum(np.minimum(relevant_count, k), 1),
+    })[relevant_count > 0]
+
+    summary = {
+        f'precision@{k}': per_user['precision'].mean(),
+        f'recall@{k}': per_user['recall'].mean(),
+        f'ndcg@{k}': per_user['ndcg'].mean(),
+        f'map@{k}': per_user['ap'].mean(),
+        'coverage': len(np.unique(recs[recs >= 0])) / catalogue_size,
+        'users': len(per_user),
+    }
+    return summary, per_user
+
+
+def evaluate_ranking(model, test_df, train_df=None, k=10, n_jobs=None):
+    relevant_df = relevant_pairs(test_df, train_df)
+    users = np.sort(test_df['user_id'].unique())
+    recs = recommend_all(model, users, k, n_jobs)
+    catalogue_df = test_df if train_df is None else train_df
+    return ranking_metrics(users, recs, relevant_df, catalogue_df['item_id'].nunique())
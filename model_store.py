@@ -0,0 +1,307 @@
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import pickle
+import shutil
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from annoy import AnnoyIndex
+from scipy import sparse as sp
+
+ARTIFACTS_PATH = 'models/artifacts'
+# перенавчені моделі: VERSIONS_PATH/<version>/<model_name>, поточна версія копіюється в ARTIFACTS_PATH
+VERSIONS_PATH = 'models/versions'
+# змінюється, коли змінюється формат файлів: артефакти зі старою версією вважаються відсутніми
+SCHEMA_VERSION = 1
+# ContentBasedModel будує annoy-індекс з метрикою angular
+ANNOY_METRIC = 'angular'
+ID_MAPPINGS = ('user_ids', 'item_ids')
+# атрибути процесу, а не моделі: не пишуться в артефакт
+TRANSIENT_ATTRIBUTES = ('_artifact', '_lock', '_updated_similarity')
+
+
+def model_path(model_name, path=ARTIFACTS_PATH):
+    return os.path.join(path, model_name)
+
+
+def read_manifest(model_name, path=ARTIFACTS_PATH):
+    with open(os.path.join(model_path(model_name, path), 'manifest.json')) as f:
+        return json.load(f)
+
+
+def exists(model_name, path=ARTIFACTS_PATH):
+    try:
+        return read_manifest(model_name, path)['schema_version'] == SCHEMA_VERSION
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def training_data_summary(train_df):
+    # хеш не залежить від порядку рядків; max_timestamp - щоб дешево порівнювати з таблицею ratings
+    hashes = pd.util.hash_pandas_object(train_df[['user_id', 'item_id', 'rating']], index=False).to_numpy()
+    summary = {'hash': hashlib.sha1(np.sort(hashes).tobytes()).hexdigest(), 'rows': len(train_df)}
+    if 'timestamp' in train_df.columns and len(train_df):
+        summary['max_timestamp'] = int(train_df['timestamp'].max())
+    return summary
+
+
+def _json_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError
+
+
+def _same_array(a, b):
+    return a.shape == b.shape and a.strides == b.strides and \
+        a.__array_interface__['data'][0] == b.__array_interface__['data'][0]
+
+
+def _is_numeric(dtype):
+    return dtype.kind in 'biuf'
+
+
+def _is_labels(index):
+    # невеликий індекс з рядків (назви колонок) пишеться прямо в маніфест
+    return isinstance(index, pd.Index) and not isinstance(index, pd.MultiIndex) and \
+        (_is_numeric(index.dtype) or len(index) <= 10000 and all(isinstance(label, str) for label in index))
+
+
+class _Writer:
+    def __init__(self, path):
+        self.path = path
+        self.saved_arrays = []
+
+    def array(self, file_name, value):
+        # масив, що вже записаний (DataFrame над cosine_matrix), на диску і в пам'яті лишається один
+        value = np.asarray(value)
+        for array, saved_file_name in self.saved_arrays:
+            if _same_array(value, array):
+                return saved_file_name
+        np.save(os.path.join(self.path, file_name), value)
+        self.saved_arrays.append((value, file_name))
+        return file_name
+
+    def attribute(self, name, value):
+        if isinstance(value, np.ndarray) and _is_numeric(value.dtype):
+            return {'kind': 'array', 'file': self.array(f'{name}.npy', value),
+                    'dtype': value.dtype.str, 'shape': list(value.shape)}
+        if isinstance(value, pd.Index) and _is_labels(value) and not _is_numeric(value.dtype):
+            return {'kind': 'labels', 'values': list(value), 'name': value.name}
+        if isinstance(value, pd.Index) and _is_labels(value):
+            return {'kind': 'index', 'file': self.array(f'{name}.npy', value.to_numpy()), 'name': value.name,
+                    'length': len(value)}
+        if isinstance(value, pd.Series) and _is_numeric(value.dtype) and _is_labels(value.index):
+            return {'kind': 'series', 'file': self.array(f'{name}.npy', value.to_numpy()), 'name': value.name,
+                    'index': self.attribute(f'{name}.index', value.index)}
+        if isinstance(value, pd.DataFrame) and len(set(value.dtypes)) == 1 and _is_numeric(value.dtypes.iloc[0]) \
+                and _is_labels(value.index) and _is_labels(value.columns):
+            return {'kind': 'frame', 'file': self.array(f'{name}.npy', value.to_numpy()),
+                    'index': self.attribute(f'{name}.index', value.index),
+                    'columns': self.attribute(f'{name}.columns', value.columns)}
+        if sp.issparse(value) and value.format in ('csr', 'csc'):
+            return {'kind': 'sparse', 'format': value.format, 'shape': list(value.shape),
+                    'data': self.array(f'{name}.data.npy', value.data),
+                    'indices': self.array(f'{name}.indices.npy', value.indices),
+                    'indptr': self.array(f'{name}.indptr.npy', value.indptr)}
+        if isinstance(value, AnnoyIndex):
+            value.save(os.path.join(self.path, f'{name}.ann'))
+            return {'kind': 'annoy', 'file': f'{name}.ann', 'f': value.f}
+        # решта (NMF з sklearn, DataFrame зі змішаними типами) - невеликі, окремим pickle
+        with open(os.path.join(self.path, f'{name}.pickle'), 'wb') as f:
+            pickle.dump(value, f)
+        return {'kind': 'pickle', 'file': f'{name}.pickle'}
+
+
+def _replace_dir(source_path, target_path):
+    # дві швидкі заміни замість видалення на місці: читачі майже не бачать моменту без каталогу;
+    # відкриті (mmap) файли старої версії лишаються доступними процесам, що їх використовують
+    old_path = target_path + '.old'
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(target_path):
+        os.rename(target_path, old_path)
+    os.rename(source_path, target_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def save(model, path=ARTIFACTS_PATH, version=None):
+    # артефакт моделі - каталог з manifest.json і плоскими файлами атрибутів (.npy, .ann);
+    # скалярні параметри моделі пишуться прямо в маніфест
+    attributes = _loaded_attributes(model)
+    target_path = model_path(model.model_name, path)
+    tmp_path = target_path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    writer = _Writer(tmp_path)
+    manifest = {'schema_version': SCHEMA_VERSION, 'model_name': model.model_name,
+                'version': version or time.strftime('%Y%m%d%H%M%S'),
+                'model_class': f'{type(model).__module__}.{type(model).__name__}',
+                'created_at': int(time.time()), 'training_data': attributes.pop('training_data', None),
+                'params': {}, 'attributes': {}}
+    for name, value in attributes.items():
+        try:
+            manifest['params'][name] = json.loads(json.dumps(value, default=_json_value))
+        except (TypeError, ValueError):
+            manifest['attributes'][name] = writer.attribute(name, value)
+    manifest['id_mappings'] = {name: manifest['attributes'][name]['length'] for name in ID_MAPPINGS
+                               if manifest['attributes'].get(name, {}).get('kind') == 'index'}
+
+    with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    _replace_dir(tmp_path, target_path)
+    return target_path
+
+
+def versions(model_name, versions_path=VERSIONS_PATH):
+    if not os.path.exists(versions_path):
+        return []
+    return sorted(version for version in os.listdir(versions_path)
+                  if exists(model_name, os.path.join(versions_path, version)))
+
+
+def promote(model_name, version, versions_path=VERSIONS_PATH, path=ARTIFACTS_PATH):
+    # збережена версія стає поточною: її підхоплять воркери, що перевіряють маніфест;
+    # promoted_at - час, з якого RetrainingScheduler відраховує наступне перенавчання
+    target_path = model_path(model_name, path)
+    tmp_path = target_path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    shutil.copytree(model_path(model_name, os.path.join(versions_path, version)), tmp_path)
+    manifest_path = os.path.join(tmp_path, 'manifest.json')
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    manifest['promoted_at'] = int(time.time())
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    _replace_dir(tmp_path, target_path)
+    return target_path
+
+
+def prune_versions(model_name, keep=5, versions_path=VERSIONS_PATH):
+    for version in versions(model_name, versions_path)[:-keep]:
+        shutil.rmtree(model_path(model_name, os.path.join(versions_path, version)), ignore_errors=True)
+        if not os.listdir(os.path.join(versions_path, version)):
+            os.rmdir(os.path.join(versions_path, version))
+
+
+def artifact_version(manifest):
+    # артефакти без версії в маніфесті - за часом створення, у тому самому форматі
+    return manifest.get('version') or time.strftime('%Y%m%d%H%M%S', time.localtime(manifest['created_at']))
+
+
+def loaded_version(model):
+    artifact = model.__dict__.get('_artifact')
+    return artifact_version(artifact.manifest) if artifact is not None else None
+
+
+def _loaded_attributes(model):
+    artifact = model.__dict__.get('_artifact')
+    if artifact is not None:
+        for name in artifact.attributes:
+            getattr(model, name)
+    return {name: value for name, value in model.__dict__.items() if name not in TRANSIENT_ATTRIBUTES}
+
+
+class Artifact:
+    # атрибути моделі, завантаженої з артефакту, читаються при першому зверненні (BaseModel.__getattr__);
+    # масиви відображаються в пам'ять: процеси, що відкрили ті самі файли, ділять одну фізичну копію,
+    # а з mmap_mode='c' запис (update моделі) потрапляє лише в приватні сторінки процесу
+    def __init__(self, path, manifest, mmap_mode='c'):
+        self.path = path
+        self.manifest = manifest
+        self.attributes = manifest['attributes']
+        self.mmap_mode = mmap_mode
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def load_attribute(self, model, name):
+        with self._lock:
+            if name not in model.__dict__:
+                model.__dict__[name] = self._load(self.attributes[name])
+            return model.__dict__[name]
+
+    def _array(self, file_name):
+        return np.load(os.path.join(self.path, file_name), mmap_mode=self.mmap_mode)
+
+    def _load(self, layout):
+        kind = layout['kind']
+        if kind == 'array':
+            return self._array(layout['file'])
+        if kind == 'labels':
+            return pd.Index(layout['values'], name=layout['name'])
+        if kind == 'index':
+            return pd.Index(self._array(layout['file']), name=layout['name'], copy=False)
+        if kind == 'series':
+            return pd.Series(self._array(layout['file']), index=self._load(layout['index']), name=layout['name'],
+                             copy=False)
+        if kind == 'frame':
+            return pd.DataFrame(self._array(layout['file']), index=self._load(layout['index']),
+                                columns=self._load(layout['columns']), copy=False)
+        if kind == 'sparse':
+            matrix_class = sp.csr_matrix if layout['format'] == 'csr' else sp.csc_matrix
+            return matrix_class((self._array(layout['data']), self._array(layout['indices']),
+                                 self._array(layout['indptr'])), shape=tuple(layout['shape']), copy=False)
+        if kind == 'annoy':
+            index = AnnoyIndex(layout['f'], ANNOY_METRIC)
+            index.load(os.path.join(self.path, layout['file']))
+            return index
+        with open(os.path.join(self.path, layout['file']), 'rb') as f:
+            return pickle.load(f)
+
+
+def load(model_name, path=ARTIFACTS_PATH, mmap_mode='c', lazy=True):
+    manifest = read_manifest(model_name, path)
+    if manifest['schema_version'] != SCHEMA_VERSION:
+        raise ValueError(f'{model_name} artifact has schema version {manifest["schema_version"]}, '
+                         f'expected {SCHEMA_VERSION}')
+    module_name, class_name = manifest['model_class'].rsplit('.', 1)
+    model = object.__new__(getattr(importlib.import_module(module_name), class_name))
+    model.__dict__.update(manifest['params'])
+    model.training_data = manifest['training_data']
+    model._artifact = Artifact(model_path(model_name, path), manifest, mmap_mode)
+    if not lazy:
+        _loaded_attributes(model)
+    return model
+
+
+def stale_reasons(model_name, path=ARTIFACTS_PATH, train_df=None, get_connection=None):
+    # порожній список - артефакт відповідає даним; train_df - точна перевірка хешем,
+    # get_connection - дешева: чи є в таблиці ratings оцінки, новіші за навчальні дані
+    training_data = read_manifest(model_name, path)['training_data']
+    if training_data is None:
+        return ['training data of the artifact is unknown']
+    reasons = []
+    if train_df is not None:
+        summary = training_data_summary(train_df)
+        if summary['hash'] != training_data['hash']:
+            reasons.append(f'training data changed: {training_data["rows"]} -> {summary["rows"]} ratings')
+    if get_connection is not None and 'max_timestamp' in training_data:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT max(timestamp) FROM ratings')
+            max_timestamp, = cur.fetchone()
+            cur.close()
+        if max_timestamp is not None and max_timestamp > training_data['max_timestamp']:
+            reasons.append(f'ratings newer than the training data: {max_timestamp} > {training_data["max_timestamp"]}')
+    return reasons
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Convert pickled models to model artifacts')
+    arg_parser.add_argument('--models', nargs='+', default=['collaborative_filtering', 'content_based'])
+    args = arg_parser.parse_args()
+    from batch_recommendations import load_pickled_model
+    for name in args.models:
+        print(save(load_pickled_model(name)))
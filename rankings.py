@@ -0,0 +1,60 @@
+import threading
+import time
+
+MOST_POPULAR_QUERY = "select full_movies.item_id, full_movies.title, full_movies.release_date, full_movies.imdb_url_new, full_movies.poster_url, count(ratings.user_id) as number_of_ratings from full_movies inner join ratings on (full_movies.item_id=ratings.item_id) group by 1, 2, 3, 4, 5 order by 6 desc limit {size}"
+MOST_RATED_QUERY = "select full_movies.item_id, full_movies.title, full_movies.release_date, full_movies.imdb_url_new, avg(ratings.rating) as avg_rating from full_movies inner join ratings on (full_movies.item_id=ratings.item_id) group by 1, 2, 3, 4 having count(ratings.user_id) >= {min_ratings} order by 5 desc limit {size}"
+
+
+class HomepageRankings:
+    # знімок найпопулярніших і найкраще оцінених фільмів для головних сторінок;
+    # оновлюється у фоновому потоці раз на refresh_interval секунд або після refresh_after_ratings нових оцінок
+    def __init__(self, get_connection, size=12, min_ratings=20, refresh_interval=300, refresh_after_ratings=100):
+        self.get_connection = get_connection
+        self.size = size
+        self.min_ratings = min_ratings
+        self.refresh_interval = refresh_interval
+        self.refresh_after_ratings = refresh_after_ratings
+        self.refreshed_at = None
+        self._snapshot = None
+        self._new_ratings = 0
+        self._refresh_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        with self._refresh_lock:
+            with self.get_connection() as conn:
+                cur = conn.cursor()
+                cur.execute(MOST_POPULAR_QUERY.format(size=self.size))
+                most_popular_movies = cur.fetchall()
+                cur.execute(MOST_RATED_QUERY.format(size=self.size, min_ratings=self.min_ratings))
+                most_rated_movies = cur.fetchall()
+                cur.close()
+            self._new_ratings = 0
+            self._snapshot = (most_popular_movies, most_rated_movies)
+            self.refreshed_at = time.time()
+
+    def snapshot(self, size=None):
+        if self._snapshot is None:
+            self.refresh()
+        most_popular_movies, most_rated_movies = self._snapshot
+        return most_popular_movies[:size], most_rated_movies[:size]
+
+    def rating_added(self):
+        self._new_ratings += 1
+        if self._new_ratings >= self.refresh_after_ratings:
+            self._wakeup.set()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='homepage-rankings', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                print('homepage rankings refresh failed:', e)
+            self._wakeup.wait(self.refresh_interval)
+            self._wakeup.clear()
@@ -0,0 +1,63 @@
+import threading
+import time
+
+
+class RatingsFeed:
+    # оцінки, які записали інші воркери gunicorn: кожен воркер раз на poll_interval секунд читає з ratings
+    # нові рядки й передає їх listener(user, film, rating, timestamp) - онлайн-оновлення моделі і скидання кешу;
+    # timestamp оцінки ставиться при запиті, а в БД вона потрапляє з буфера пізніше, тому рядки читаються
+    # з запасом overlap секунд, а вже оброблені відкидаються за ключем (user, film, timestamp)
+    def __init__(self, get_connection, listener, poll_interval=2, overlap=60):
+        self.get_connection = get_connection
+        self.listener = listener
+        self.poll_interval = poll_interval
+        self.overlap = overlap
+        self.since = None
+        self._seen = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def mark_seen(self, user, film, timestamp):
+        # оцінки цього воркера вже оброблені при запиті
+        with self._lock:
+            self._seen[(user, film, timestamp)] = timestamp
+
+    def poll(self):
+        with self.get_connection() as conn:
+            cur = conn.cursor()
+            if self.since is None:
+                # після старту - лише оцінки, що з'являться далі: попередні вже враховані при завантаженні моделі
+                cur.execute('SELECT max(timestamp) FROM ratings')
+                self.since, = cur.fetchone()
+                self.since = self.since or 0
+                cur.close()
+                return 0
+            cur.execute(f'SELECT user_id, item_id, rating, timestamp FROM ratings '
+                        f'WHERE timestamp >= {int(self.since) - self.overlap} ORDER BY timestamp')
+            rows = cur.fetchall()
+            cur.close()
+
+        with self._lock:
+            new_rows = [row for row in rows if (row[0], row[1], row[3]) not in self._seen]
+            for user, film, _, timestamp in new_rows:
+                self._seen[(user, film, timestamp)] = timestamp
+            if rows:
+                self.since = max(self.since, rows[-1][3])
+            self._seen = {key: timestamp for key, timestamp in self._seen.items()
+                          if timestamp >= self.since - self.overlap}
+        for user, film, rating, timestamp in new_rows:
+            self.listener(user, film, rating, timestamp)
+        return len(new_rows)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='ratings-feed', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                print('ratings feed poll failed:', e)
+            time.sleep(self.poll_interval)
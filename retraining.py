@@ -0,0 +1,287 @@
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+import model_store
+from base_model import CollaborativeFilteringModel, ContentBasedModel
+from metrics import evaluate_ranking
+from train_test_split import train_test_split_indices
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокування немає, перенавчання запускає кожен процес
+    fcntl = None
+
+MODELS = {'collaborative_filtering': CollaborativeFilteringModel, 'content_based': ContentBasedModel}
+MOVIES_PATH = 'data/raw/100k/movies.csv'
+LOCK_PATH = 'models/retraining.lock'
+RETRAIN_INTERVAL = int(os.environ.get('RECSYS_RETRAIN_INTERVAL', 24 * 3600))
+RETRAIN_AFTER_RATINGS = int(os.environ.get('RECSYS_RETRAIN_AFTER_RATINGS', 1000))
+VALIDATION_METRIC = 'ndcg@10'
+
+
+def load_ratings(get_connection):
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT user_id, item_id, rating, timestamp FROM ratings')
+        rating_df = pd.DataFrame(cur.fetchall(), columns=['user_id', 'item_id', 'rating', 'timestamp'])
+        cur.close()
+    return rating_df
+
+
+def load_movies(path=MOVIES_PATH):
+    movies_df = pd.read_csv(path)
+    movies_df.drop([266], axis=0, inplace=True)
+    movies_df.drop(['Unnamed: 0'], axis=1, inplace=True)
+    return movies_df
+
+
+def fit_model(model_name, rating_df, movies_df=None):
+    if model_name not in MODELS:
+        raise ValueError(f'No such model: only {", ".join(MODELS)}')
+    model = MODELS[model_name]()
+    if model_name == 'content_based':
+        model.fit(movies_df, rating_df)
+    else:
+        model.fit(rating_df)
+    return model
+
+
+def holdout_split(rating_df, train_part=0.8):
+    # ранні оцінки - для навчання, останні за часом - для перевірки
+    train_idx, test_idx = train_test_split_indices(rating_df, 'timestamp', train_part)
+    return rating_df.iloc[train_idx].reset_index(drop=True), rating_df.iloc[test_idx].reset_index(drop=True)
+
+
+def score(model, train_df, test_df, k=10):
+    summary, _ = evaluate_ranking(model, test_df, train_df, k)
+    return {name: float(value) for name, value in summary.items()}
+
+
+def validate(model_name, train_df, test_df, movies_df=None, k=10):
+    return score(fit_model(model_name, train_df, movies_df), train_df, test_df, k)
+
+
+def train(model_name, version, versions_path=model_store.VERSIONS_PATH, movies_path=MOVIES_PATH,
+          path=model_store.ARTIFACTS_PATH):
+    # виконується в окремому процесі (python -m retraining train): результат - артефакт нової версії
+    # з оцінкою на відкладених даних у параметрі validation і оцінкою поточної версії на тих самих даних
+    # у current_validation
+    from db import get_db_connection
+    rating_df = load_ratings(get_db_connection)
+    movies_df = load_movies(movies_path) if model_name == 'content_based' else None
+    train_df, test_df = holdout_split(rating_df)
+    current_validation = None
+    if model_store.exists(model_name, path):
+        # поточна версія не рекомендує фільми, оцінені в її навчальних даних, тож порівнювати версії можна
+        # лише на відкладених оцінках, новіших за ці дані
+        current_model = model_store.load(model_name, path, lazy=False)
+        max_timestamp = (current_model.training_data or {}).get('max_timestamp')
+        if max_timestamp is not None and (test_df['timestamp'] > max_timestamp).any():
+            test_df = test_df[test_df['timestamp'] > max_timestamp].reset_index(drop=True)
+            current_validation = score(current_model, train_df, test_df)
+    validation = validate(model_name, train_df, test_df, movies_df)
+    model = fit_model(model_name, rating_df, movies_df)
+    model.validation = validation
+    model.current_validation = current_validation
+    return model_store.save(model, os.path.join(versions_path, version), version)
+
+
+def check_validation(model_name, version, versions_path=model_store.VERSIONS_PATH, tolerance=0.05):
+    # нова версія приймається, якщо її метрика не гірша за метрику поточної на тих самих відкладених даних
+    # більше ніж на tolerance
+    params = model_store.read_manifest(model_name, os.path.join(versions_path, version))['params']
+    new_score = (params.get('validation') or {}).get(VALIDATION_METRIC)
+    if new_score is None or np.isnan(new_score):
+        return False, f'no {VALIDATION_METRIC} on validation'
+    current_score = (params.get('current_validation') or {}).get(VALIDATION_METRIC)
+    if current_score is None or np.isnan(current_score):
+        return True, f'{VALIDATION_METRIC} {new_score:.4f}'
+    if new_score < (1 - tolerance) * current_score:
+        return False, f'{VALIDATION_METRIC} {new_score:.4f} < {current_score:.4f} of the current version'
+    return True, f'{VALIDATION_METRIC} {new_score:.4f}, current {current_score:.4f}'
+
+
+def archive_current(model_name, versions_path=model_store.VERSIONS_PATH, path=model_store.ARTIFACTS_PATH):
+    # поточний артефакт (навчений при старті app.py або сконвертований) теж має бути серед версій для відкату
+    if not model_store.exists(model_name, path):
+        return
+    version = model_store.artifact_version(model_store.read_manifest(model_name, path))
+    version_path = model_store.model_path(model_name, os.path.join(versions_path, version))
+    if not os.path.exists(version_path):
+        shutil.copytree(model_store.model_path(model_name, path), version_path)
+
+
+def retrain(model_name, versions_path=model_store.VERSIONS_PATH, path=model_store.ARTIFACTS_PATH, tolerance=0.05,
+            keep=5, timeout=None):
+    version = time.strftime('%Y%m%d%H%M%S')
+    start = time.time()
+    subprocess.run([sys.executable, '-m', 'retraining', 'train', '--models', model_name, '--version', version,
+                    '--versions-path', versions_path, '--path', path], check=True, timeout=timeout)
+    accepted, message = check_validation(model_name, version, versions_path, tolerance)
+    if not accepted:
+        shutil.rmtree(model_store.model_path(model_name, os.path.join(versions_path, version)), ignore_errors=True)
+        print(f'{model_name} version {version} rejected: {message}')
+        return None
+    archive_current(model_name, versions_path, path)
+    model_store.promote(model_name, version, versions_path, path)
+    model_store.prune_versions(model_name, keep, versions_path)
+    print(f'{model_name} version {version} promoted in {time.time() - start:.0f} s: {message}')
+    return version
+
+
+def rollback(model_name, versions_path=model_store.VERSIONS_PATH, path=model_store.ARTIFACTS_PATH):
+    current_version = model_store.artifact_version(model_store.read_manifest(model_name, path))
+    previous_versions = [version for version in model_store.versions(model_name, versions_path)
+                         if version < current_version]
+    if not previous_versions:
+        raise ValueError(f'No version of {model_name} older than {current_version}')
+    model_store.promote(model_name, previous_versions[-1], versions_path, path)
+    print(f'{model_name} rolled back from {current_version} to {previous_versions[-1]}')
+    return previous_versions[-1]
+
+
+def replay_ratings(model, get_connection):
+    # оцінки, що з'явились після знімка навчальних даних, додаються в модель без перенавчання
+    max_timestamp = (model.training_data or {}).get('max_timestamp')
+    if max_timestamp is None or not hasattr(model, 'update'):
+        return 0
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f'SELECT user_id, item_id, rating FROM ratings WHERE timestamp > {max_timestamp} ORDER BY timestamp')
+        new_ratings = cur.fetchall()
+        cur.close()
+    new_ratings = [(user, film, rating) for user, film, rating in new_ratings if model.can_update(user, film)]
+    for user, film, rating in new_ratings:
+        model.update(user, film, rating)
+    return len(new_ratings)
+
+
+class RetrainingScheduler:
+    # перенавчання раз на interval секунд або коли в ratings з'явилось after_ratings оцінок, новіших
+    # за навчальні дані поточної версії; з кількох воркерів його запускає лише той, що тримає LOCK_PATH
+    def __init__(self, get_connection, model_names, interval=RETRAIN_INTERVAL, after_ratings=RETRAIN_AFTER_RATINGS,
+                 check_interval=60, retry_interval=3600, path=model_store.ARTIFACTS_PATH):
+        self.get_connection = get_connection
+        self.model_names = model_names
+        self.interval = interval
+        self.after_ratings = after_ratings
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        self.path = path
+        self._attempted_at = {}
+        self._lock_file = None
+        self._thread = None
+
+    def due(self, model_name):
+        # відлік - від того, як версія стала поточною (promoted_at): після відкату старої версії
+        # перенавчання чекає interval або after_ratings оцінок, що з'явились уже після відкату
+        if time.time() - self._attempted_at.get(model_name, 0) < self.retry_interval:
+            return False
+        manifest = model_store.read_manifest(model_name, self.path)
+        promoted_at = manifest.get('promoted_at', manifest['created_at'])
+        if time.time() - promoted_at >= self.interval:
+            return True
+        max_timestamp = (manifest['training_data'] or {}).get('max_timestamp')
+        if max_timestamp is None:
+            return False
+        if 'promoted_at' in manifest:
+            max_timestamp = max(max_timestamp, manifest['promoted_at'])
+        with self.get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f'SELECT count(*) FROM ratings WHERE timestamp > {max_timestamp}')
+            new_ratings, = cur.fetchone()
+            cur.close()
+        return new_ratings >= self.after_ratings
+
+    def run_once(self):
+        for model_name in self.model_names:
+            if self.due(model_name):
+                self._attempted_at[model_name] = time.time()
+                retrain(model_name, path=self.path)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='retraining-scheduler', daemon=True)
+            self._thread.start()
+
+    def _acquire_lock(self):
+        if fcntl is None or self._lock_file is not None:
+            return True
+        lock_file = open(LOCK_PATH, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def _run(self):
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                if self._acquire_lock():
+                    self.run_once()
+            except Exception as e:
+                print('retraining failed:', e)
+
+
+class ModelReloader:
+    # кожен воркер перевіряє версію в маніфесті поточного артефакту і підміняє модель у service,
+    # якщо її перенавчили або відкотили
+    def __init__(self, service, get_connection, check_interval=30, path=model_store.ARTIFACTS_PATH):
+        self.service = service
+        self.get_connection = get_connection
+        self.check_interval = check_interval
+        self.path = path
+        self._thread = None
+
+    def check(self):
+        for model in list(self.service.models().values()):
+            version = model_store.artifact_version(model_store.read_manifest(model.model_name, self.path))
+            if version == model_store.loaded_version(model):
+                continue
+            # без lazy: файли артефакту можуть бути замінені наступною версією до першого звернення до атрибута
+            new_model = model_store.load(model.model_name, self.path, lazy=False)
+            replayed = replay_ratings(new_model, self.get_connection)
+            self.service.swap_model(new_model)
+            print(f'{model.model_name} model {version} loaded, {replayed} new ratings replayed')
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='model-reloader', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                self.check()
+            except Exception as e:
+                print('model reload failed:', e)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Retrain, validate and promote models, or roll them back')
+    arg_parser.add_argument('command', choices=['train', 'retrain', 'rollback'])
+    arg_parser.add_argument('--models', nargs='+', default=list(MODELS), choices=list(MODELS))
+    arg_parser.add_argument('--version', default=None)
+    arg_parser.add_argument('--versions-path', default=model_store.VERSIONS_PATH)
+    arg_parser.add_argument('--path', default=model_store.ARTIFACTS_PATH)
+    arg_parser.add_argument('--tolerance', type=float, default=0.05)
+    args = arg_parser.parse_args()
+    for name in args.models:
+        if args.command == 'train':
+            print(train(name, args.version or time.strftime('%Y%m%d%H%M%S'), args.versions_path, path=args.path))
+        elif args.command == 'retrain':
+            retrain(name, args.versions_path, args.path, tolerance=args.tolerance)
+        else:
+            rollback(name, args.versions_path, args.path)
@@ -0,0 +1,148 @@
+import bisect
+import threading
+import time
+from collections import defaultdict
+
+MOVIES_QUERY = "SELECT item_id, title, release_date, imdb_url_new, title_ua FROM full_movies"
+MOVIES_VERSION_QUERY = "SELECT count(*), max(item_id) FROM full_movies"
+
+
+def normalize(text):
+    return ' '.join(str(text or '').lower().split())
+
+
+def ngrams(text, n):
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+class TitleSearchIndex:
+    # інвертований індекс n-грам (1..3 символи) по title і title_ua:
+    # підрядковий пошук як у LIKE '%keyword%', нечіткий пошук по триграмах і автодоповнення по префіксу;
+    # фоновий потік раз на check_interval секунд звіряє кількість фільмів і їх max(item_id) і перебудовує індекс,
+    # якщо вони змінились, а раз на refresh_interval секунд - у будь-якому разі (змінені назви)
+    def __init__(self, get_connection=None, max_n=3, refresh_interval=3600, check_interval=30):
+        self.get_connection = get_connection
+        self.max_n = max_n
+        self.refresh_interval = refresh_interval
+        self.check_interval = check_interval
+        self.refreshed_at = None
+        self._version = None
+        self.movies = {}
+        self._texts = {}
+        self._postings = defaultdict(set)
+        self._prefixes = []
+        self._lock = threading.Lock()
+        self._built = False
+        self._thread = None
+
+    def refresh(self):
+        with self.get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(MOVIES_VERSION_QUERY)
+            version = tuple(cur.fetchone())
+            cur.execute(MOVIES_QUERY)
+            rows = cur.fetchall()
+            cur.close()
+        self.build(rows)
+        self._version = version
+        self.refreshed_at = time.time()
+
+    def changed(self):
+        with self.get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(MOVIES_VERSION_QUERY)
+            version = tuple(cur.fetchone())
+            cur.close()
+        return version != self._version
+
+    def build(self, rows):
+        with self._lock:
+            self.movies = {}
+            self._texts = {}
+            self._postings = defaultdict(set)
+            self._prefixes = []
+            for row in rows:
+                self._add(row)
+            self._prefixes.sort()
+            self._built = True
+
+    def _add(self, row):
+        item_id = row[0]
+        texts = {normalize(title) for title in row[1:2] + row[4:5] if title}
+        self.movies[item_id] = tuple(row[:4])
+        self._texts[item_id] = texts
+        for text in texts:
+            for n in range(1, self.max_n + 1):
+                for gram in ngrams(text, n):
+                    self._postings[gram].add(item_id)
+            self._prefixes.append((text, item_id))
+
+    def _ensure_built(self):
+        if not self._built:
+            self.refresh()
+
+    def search(self, keyword, limit=None, fuzzy=True, min_similarity=0.5):
+        self._ensure_built()
+        query = normalize(keyword)
+        if not query:
+            return list(self.movies.values())[:limit]
+
+        with self._lock:
+            n = min(len(query), self.max_n)
+            grams = ngrams(query, n)
+            candidates = set.intersection(*(self._postings.get(gram, set()) for gram in grams))
+            matched = [item_id for item_id in candidates
+                       if any(query in text for text in self._texts[item_id])]
+            matched.sort(key=lambda item_id: self._rank(item_id, query))
+
+            if fuzzy and len(query) >= self.max_n:
+                overlap = defaultdict(int)
+                for gram in grams:
+                    for item_id in self._postings.get(gram, ()):
+                        overlap[item_id] += 1
+                matched_set = set(matched)
+                similar = [(count / len(grams), item_id) for item_id, count in overlap.items()
+                           if item_id not in matched_set and count / len(grams) >= min_similarity]
+                similar.sort(key=lambda pair: (-pair[0], self.movies[pair[1]][1]))
+                matched += [item_id for _, item_id in similar]
+
+            return [self.movies[item_id] for item_id in matched[:limit]]
+
+    def _rank(self, item_id, query):
+        # спочатку назви, що починаються з запиту, потім слова, що починаються з запиту, потім решта
+        texts = self._texts[item_id]
+        if any(text.startswith(query) for text in texts):
+            position = 0
+        elif any(word.startswith(query) for text in texts for word in text.split()):
+            position = 1
+        else:
+            position = 2
+        return position, min(len(text) for text in texts), self.movies[item_id][1]
+
+    def complete(self, prefix, limit=10):
+        self._ensure_built()
+        prefix = normalize(prefix)
+        with self._lock:
+            start = bisect.bisect_left(self._prefixes, (prefix,))
+            titles = []
+            for text, item_id in self._prefixes[start:]:
+                if not text.startswith(prefix) or len(titles) >= limit:
+                    break
+                if self.movies[item_id] not in titles:
+                    titles.append(self.movies[item_id])
+            return titles
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='title-search-index', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                if self.refreshed_at is None or time.time() - self.refreshed_at >= self.refresh_interval \
+                        or self.changed():
+                    self.refresh()
+            except Exception as e:
+                print('title search index refresh failed:', e)
+            time.sleep(self.check_interval)
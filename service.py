@@ -1,7 +1,211 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from instrumentation import cache_lookup, stage_timer
+
+MOVIES_INFO_COLUMNS = ['item_id', 'title', 'release_date', 'imdb_url', 'poster_url']
+# колонка з оцінкою в результаті top_n і знак: більше - краще (1) чи менше - краще (-1)
+SCORE_COLUMNS = {'predicted_rating': 1, 'distance': -1, 'score': 1}
+HYBRID_WEIGHTS = {'cf': 0.5, 'cb': 0.5}
+
+
+class RecommendationsCache:
+    # LRU-кеш top-N рекомендацій з обмеженим розміром і часом життя записів (ttl, секунди)
+    def __init__(self, max_size=1024, ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or time.monotonic() - item[0] > self.ttl:
+                self._items.pop(key, None)
+                self.misses += 1
+                cache_lookup(False)
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            cache_lookup(True)
+            return item[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, user):
+        with self._lock:
+            for key in [key for key in self._items if key[0] == user]:
+                del self._items[key]
+
+    def invalidate_model(self, model_name):
+        with self._lock:
+            for key in [key for key in self._items if key[1] == model_name]:
+                del self._items[key]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._items)}
+
+
 class RecommenderService:
-    def __int__(self):
-        self.uid = None
-        self.keyword = None
+    def __init__(self, cache_size=1024, cache_ttl=600, get_connection=None, max_workers=4, time_budget=1.0,
+                 batch_size=256):
         self.cf_model = None
         self.cb_model = None
+        self.cache = RecommendationsCache(cache_size, cache_ttl)
+        self.precomputed = {}
+        # рекомендації для користувачів, яких модель не знає (ще нічого не оцінили): об'єкт з top_n(user, n)
+        self.fallback = None
+        self.get_connection = get_connection
+        self.time_budget = time_budget
+        self.batch_size = batch_size
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='recommender')
+
+    def models(self):
+        return {'cf': self.cf_model, 'cb': self.cb_model}
+
+    def swap_model(self, model):
+        # заміна моделі з тим самим model_name - одне присвоєння атрибута: запити, що вже отримали
+        # посилання на стару модель, дораховуються на ній, нові - йдуть у нову
+        name = next(name for name, current in self.models().items() if current.model_name == model.model_name)
+        previous_model = getattr(self, f'{name}_model')
+        setattr(self, f'{name}_model', model)
+        self.precomputed.pop(model.model_name, None)
+        self.cache.invalidate_model(model.model_name)
+        return previous_model
+
+    def top_n(self, model, user, n=10):
+        # спершу - попередньо розраховані рекомендації, якщо користувач нічого не оцінював після їх генерації
+        precomputed = self.precomputed.get(model.model_name)
+        if precomputed is not None:
+            recs = precomputed.top_n(user, n)
+            if recs is not None:
+                return recs
+
+        key = (user, model.model_name, n)
+        recs = self.cache.get(key)
+        if recs is None:
+            with stage_timer(f'{model.model_name}.top_n'):
+                recs = model_top_n(model, user, n)
+            if recs is None:
+                # не кешуються: після першої ж оцінки користувача їх мають замінити рекомендації моделі
+                return self.fallback_top_n(user, n)
+            self.cache.put(key, recs)
+        return recs
+
+    def fallback_top_n(self, user, n=10):
+        if self.fallback is None:
+            return None
+        with stage_timer(f'{self.fallback.model_name}.top_n'):
+            return self.fallback.top_n(user, n)
+
+    def top_n_batch(self, model, users, n=10):
+        # попередньо розраховані рекомендації, решта користувачів - одним пакетним викликом моделі;
+        # кеш не використовується, щоб масові вибірки не витісняли з нього інтерактивних користувачів
+        precomputed = self.precomputed.get(model.model_name)
+        recs = [precomputed.top_n(user, n) if precomputed is not None else None for user in users]
+        missing = [i for i, user_recs in enumerate(recs) if user_recs is None]
+        if missing:
+            with stage_timer(f'{model.model_name}.top_n_batch'):
+                missing_recs = model.top_n_batch([users[i] for i in missing], n)
+            for i, user_recs in zip(missing, missing_recs):
+                recs[i] = user_recs if user_recs is not None else self.fallback_top_n(users[i], n)
+        return recs
+
+    def recommend_batch(self, users, n=10, model_name='cf', weights=None):
+        # генератор пар (user, рекомендації або None для невідомого користувача) по batch_size користувачів,
+        # щоб результат можна було віддавати потоком ще до кінця обчислень
+        models = self.models()
+        weights = weights or HYBRID_WEIGHTS
+        for start in range(0, len(users), self.batch_size):
+            chunk = users[start:start + self.batch_size]
+            if model_name != 'hybrid':
+                yield from zip(chunk, self.top_n_batch(models[model_name], chunk, n))
+                continue
+            futures = {name: self._executor.submit(self.top_n_batch, models[name], chunk, 2 * n) for name in weights}
+            recs = {name: future.result() for name, future in futures.items()}
+            for i, user in enumerate(chunk):
+                user_recs = {name: model_recs[i] for name, model_recs in recs.items()}
+                if all(model_recs is None for model_recs in user_recs.values()):
+                    yield user, None
+                else:
+                    yield user, blend(user_recs, weights, n)
+
+    def invalidate(self, user):
+        self.cache.invalidate(user)
+        for precomputed in self.precomputed.values():
+            precomputed.mark_stale(user)
+
+    def recommend(self, user, n=10, model_names=None, time_budgets=None):
+        # моделі рахуються паралельно; якщо модель не вклалась у свій час, її результат - None,
+        # а обчислення доробляється у фоні й потрапляє в кеш для наступного запиту
+        models = self.models()
+        model_names = model_names or list(models)
+        time_budgets = time_budgets or {}
+        start = time.monotonic()
+        futures = {name: self._executor.submit(self.top_n, models[name], user, n) for name in model_names}
+
+        recs = {}
+        for name, future in futures.items():
+            remaining = start + time_budgets.get(name, self.time_budget) - time.monotonic()
+            try:
+                recs[name] = future.result(timeout=max(remaining, 0))
+            except Exception as e:
+                print(f'{name} recommendations for user {user} are not ready: {e!r}')
+                recs[name] = None
+        return recs
+
+    def hybrid_top_n(self, user, n=10, weights=None, candidates=None):
+        # зважена сума нормованих (min-max) оцінок моделей; фільм, якого немає у списку моделі, отримує 0
+        weights = weights or HYBRID_WEIGHTS
+        recs = self.recommend(user, candidates or 2 * n, list(weights))
+        return blend(recs, weights, n)
+
+    def movies_info(self, item_ids):
+        # метадані всіх рекомендованих фільмів одним запитом
+        item_ids = sorted({int(item_id) for item_id in item_ids})
+        if not item_ids:
+            return pd.DataFrame(columns=MOVIES_INFO_COLUMNS)
+        with self.get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                f"SELECT item_id, title, release_date, imdb_url_new, poster_url FROM full_movies "
+                f"WHERE item_id in ({', '.join(map(str, item_ids))})")
+            movies_info = pd.DataFrame(cur.fetchall(), columns=MOVIES_INFO_COLUMNS)
+            cur.close()
+        return movies_info
+
+
+def model_top_n(model, user, n=10):
+    # для невідомого користувача моделі на pd.Index.get_loc кидають KeyError, ContentBasedModel повертає None
+    try:
+        return model.top_n(user, n)
+    except KeyError:
+        return None
+
 
+def blend(recs, weights, n=10):
+    scores = []
+    for name, weight in weights.items():
+        recs_df = recs.get(name)
+        if recs_df is None or len(recs_df) == 0:
+            continue
+        column = next(column for column in SCORE_COLUMNS if column in recs_df.columns)
+        score = recs_df[column].to_numpy(dtype=float) * SCORE_COLUMNS[column]
+        score_range = score.max() - score.min()
+        normalized = (score - score.min()) / score_range if score_range > 0 else score * 0 + 1
+        scores.append(pd.Series(weight * normalized, index=recs_df['item_id'].to_numpy()))
+    if not scores:
+        return pd.DataFrame(columns=['item_id', 'score'])
+    hybrid = pd.concat(scores).groupby(level=0).sum().sort_values(ascending=False).head(n)
+    return pd.DataFrame({'item_id': hybrid.index, 'score': hybrid.to_numpy()})
@@ -0,0 +1,95 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+GENRES = ['unknown', 'Action', 'Adventure', 'Animation', "Children's", 'Comedy', 'Crime', 'Documentary', 'Drama',
+          'Fantasy', 'Film-Noir', 'Horror', 'Musical', 'Mystery', 'Romance', 'Sci-Fi', 'Thriller', 'War', 'Western']
+OCCUPATIONS = ['administrator', 'artist', 'doctor', 'educator', 'engineer', 'entertainment', 'executive',
+               'healthcare', 'homemaker', 'lawyer', 'librarian', 'marketing', 'none', 'other', 'programmer',
+               'retired', 'salesman', 'scientist', 'student', 'technician', 'writer']
+# розміри як у MovieLens 100k / 1M / 10M: (кількість оцінок, користувачів, фільмів)
+SCALES = {
+    '100k': (100000, 943, 1682),
+    '1m': (1000000, 6040, 3706),
+    '10m': (10000000, 69878, 10677),
+}
+
+
+def generate_users(n_users, rng):
+    return pd.DataFrame({
+        'user_id': np.arange(1, n_users + 1),
+        'age': np.clip(rng.normal(33, 12, n_users).astype(int), 7, 73),
+        'gender': rng.choice(['M', 'F'], n_users, p=[0.71, 0.29]),
+        'occupation': rng.choice(OCCUPATIONS, n_users),
+        'zip_code': [f'{zip_code:05d}' for zip_code in rng.integers(0, 100000, n_users)],
+    })
+
+
+def generate_movies(n_items, rng):
+    release_dates = pd.to_datetime('1930-01-01') + pd.to_timedelta(rng.integers(0, 68 * 365, n_items), unit='D')
+    movies_df = pd.DataFrame({
+        'item_id': np.arange(1, n_items + 1),
+        'title': [f'Movie {item_id} ({date.year})' for item_id, date in zip(range(1, n_items + 1), release_dates)],
+        'release_date': release_dates.strftime('%d-%b-%Y'),
+        'imdb_url': [f'http://us.imdb.com/M/title-exact?Movie%20{item_id}' for item_id in range(1, n_items + 1)],
+    })
+    genres = rng.random((n_items, len(GENRES))) < 0.12
+    genres[np.arange(n_items), rng.integers(1, len(GENRES), n_items)] = True
+    genres[:, 0] = False
+    for i, genre in enumerate(GENRES):
+        movies_df[genre] = genres[:, i].astype(int)
+    return movies_df
+
+
+def generate_ratings(n_ratings, n_users, n_items, rng, popularity_exponent=1.0, start_timestamp=874724710):
+    # популярність фільмів - закон Ципфа, активність користувачів - лог-нормальна (не менше 20 оцінок)
+    item_popularity = 1 / np.arange(1, n_items + 1) ** popularity_exponent
+    item_popularity = rng.permutation(item_popularity / item_popularity.sum())
+    user_activity = rng.lognormal(0, 1, n_users)
+    users_counts = 20 + np.floor(user_activity / user_activity.sum() * max(n_ratings - 20 * n_users, 0)).astype(int)
+    users_counts = np.minimum(users_counts, n_items)
+
+    # повторні пари (user, item) видаляються, тому добираємо оцінки, доки в кожного користувача не буде users_counts
+    ratings_df = pd.DataFrame({'user_id': np.empty(0, dtype=int), 'item_id': np.empty(0, dtype=int)})
+    deficit = users_counts
+    for _ in range(20):
+        if deficit.sum() == 0:
+            break
+        user_ids = np.repeat(np.arange(1, n_users + 1), (deficit * 1.2).astype(int) + (deficit > 0) * 5)
+        item_ids = rng.choice(np.arange(1, n_items + 1), len(user_ids), p=item_popularity)
+        ratings_df = pd.concat([ratings_df, pd.DataFrame({'user_id': user_ids, 'item_id': item_ids})])
+        ratings_df = ratings_df.drop_duplicates()
+        ratings_df = ratings_df[ratings_df.groupby('user_id').cumcount().to_numpy() <
+                                users_counts[ratings_df['user_id'].to_numpy() - 1]]
+        deficit = users_counts - np.bincount(ratings_df['user_id'], minlength=n_users + 1)[1:]
+
+    item_quality = rng.normal(0, 0.6, n_items + 1)
+    user_bias = rng.normal(0, 0.4, n_users + 1)
+    rating = 3.5 + item_quality[ratings_df['item_id']] + user_bias[ratings_df['user_id']] + \
+        rng.normal(0, 0.9, len(ratings_df))
+    ratings_df['rating'] = np.clip(np.rint(rating), 1, 5).astype(int)
+    ratings_df['timestamp'] = np.sort(rng.integers(start_timestamp, start_timestamp + 3 * 365 * 86400,
+                                                   len(ratings_df)))
+    return ratings_df.sample(frac=1, random_state=int(rng.integers(2 ** 31))).reset_index(drop=True)
+
+
+def generate(scale, out_dir, seed=0):
+    # файли у тому ж форматі, що й data/raw/100k: users.csv, rating.csv, movies.csv (з колонкою 'Unnamed: 0')
+    n_ratings, n_users, n_items = SCALES[scale]
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    generate_users(n_users, rng).to_csv(os.path.join(out_dir, 'users.csv'))
+    generate_ratings(n_ratings, n_users, n_items, rng).to_csv(os.path.join(out_dir, 'rating.csv'))
+    generate_movies(n_items, rng).to_csv(os.path.join(out_dir, 'movies.csv'))
+    return out_dir
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Generate MovieLens-shaped synthetic data')
+    arg_parser.add_argument('scale', choices=list(SCALES))
+    arg_parser.add_argument('--out-dir', default=None)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+    generate(args.scale, args.out_dir or f'data/synthetic/{args.scale}', args.seed)
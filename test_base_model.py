@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from base_model import CollaborativeFilteringModel
+
+
+def random_ratings(users=60, films=40, ratings=900, seed=0):
+    rng = np.random.default_rng(seed)
+    pairs = rng.choice(users * films, ratings, replace=False)
+    return pd.DataFrame({'user_id': pairs // films + 1, 'item_id': pairs % films + 1,
+                         'rating': rng.integers(1, 6, ratings), 'timestamp': np.arange(ratings)})
+
+
+@pytest.mark.parametrize('sparse, fit_kwargs', [(False, {}), (True, {}), (True, {'top_k': 10}),
+                                                (True, {'top_k': 59})])
+def test_batched_predict_matches_per_row(sparse, fit_kwargs):
+    rating_df = random_ratings()
+    train_df, test_df = rating_df.iloc[:700], rating_df.iloc[700:]
+    # невідомий користувач з відомим фільмом і відомий користувач з невідомим фільмом
+    test_df = pd.concat([test_df, pd.DataFrame({'user_id': [999, 1], 'item_id': [1, 999], 'rating': [3, 3],
+                                                'timestamp': [0, 0]})], ignore_index=True)
+    model = CollaborativeFilteringModel(sparse=sparse)
+    model.fit(train_df, **fit_kwargs)
+
+    per_row = model.predict(test_df, batched=False)['predicted_rating'].to_numpy(dtype=float)
+    batched = model.predict(test_df)['predicted_rating'].to_numpy(dtype=float)
+    assert np.isfinite(batched).all()
+    np.testing.assert_allclose(batched, per_row, rtol=0, atol=1e-6)
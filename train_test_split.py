@@ -1,14 +1,79 @@
+import numpy as np
+
+
+def split_position(sorted_datetimes, train_part):
+    # позиція першого рядка з split_datetime у відсортованому масиві: останній момент часу,
+    # до якого (не включно) в train потрапляє менше ніж len * train_part рядків
+    datetimes, first_positions = np.unique(sorted_datetimes, return_index=True)
+    i = max(np.searchsorted(first_positions, len(sorted_datetimes) * train_part, side='left') - 1, 0)
+    return first_positions[i]
+
+
 def train_test_split(df, datetime_column, train_part):
     df = df.sort_values(datetime_column).reset_index(drop=True)
-    datetime_dict = df[datetime_column].value_counts().sort_index()
-    split_datetime = df.loc[0, datetime_column]
-
-    values_sum = 0
-    for key, value in datetime_dict.items():
-        if values_sum < len(df) * train_part:
-            split_datetime = key
-            values_sum += value
+    sorted_datetimes = df[datetime_column].to_numpy()
+    split_datetime = sorted_datetimes[split_position(sorted_datetimes, train_part)]
 
     train_df = df[df[datetime_column] < split_datetime].reset_index(drop=True)
     test_df = df[df[datetime_column] >= split_datetime].reset_index(drop=True)
     return train_df, test_df
+
+
+def train_test_split_indices(df, datetime_column, train_part):
+    # те саме розбиття, але у вигляді позиційних індексів df (без копіювання даних)
+    order = np.argsort(df[datetime_column].to_numpy(), kind='stable')
+    position = split_position(df[datetime_column].to_numpy()[order], train_part)
+    return order[:position], order[position:]
+
+
+def block_boundaries(sorted_datetimes, start, n_blocks):
+    # межі n_blocks блоків від позиції start до кінця, рівних за кількістю рядків (розміри відрізняються
+    # не більше ніж на 1, як у np.array_split); межа зсувається на перший рядок свого моменту часу,
+    # щоб однакові моменти не потрапили і в train, і в test
+    length = len(sorted_datetimes)
+    boundaries = start + (length - start) * np.arange(n_blocks + 1) // n_blocks
+    inside = boundaries < length
+    boundaries[inside] = np.searchsorted(sorted_datetimes, sorted_datetimes[boundaries[inside]], side='left')
+    return boundaries
+
+
+def temporal_splits(order, sorted_datetimes, boundaries, window_part=None):
+    # тест - кожен блок між сусідніми межами, train - усе до нього (або лише останні window_part даних)
+    splits = []
+    for start, end in zip(boundaries[:-1], boundaries[1:]):
+        train_start = 0
+        if window_part is not None:
+            train_start = block_boundaries(sorted_datetimes, max(start - int(window_part * len(order)), 0), 1)[0]
+        splits.append((order[train_start:start], order[start:end]))
+    return splits
+
+
+def rolling_origin_split(df, datetime_column, n_splits=5, min_train_part=0.5, window_part=None):
+    # n_splits розбиттів: дані після перших min_train_part діляться на n_splits рівних за кількістю рядків
+    # тестових блоків; window_part=None - train розширюється,
+    # інакше train - лише останні window_part даних перед тестом
+    order = np.argsort(df[datetime_column].to_numpy(), kind='stable')
+    sorted_datetimes = df[datetime_column].to_numpy()[order]
+    boundaries = block_boundaries(sorted_datetimes, int(len(order) * min_train_part), n_splits)
+    return temporal_splits(order, sorted_datetimes, boundaries, window_part)
+
+
+def time_series_k_fold(df, datetime_column, n_splits=5):
+    # дані діляться на n_splits + 1 рівних за кількістю рядків проміжків часу,
+    # k-й фолд навчається на перших k проміжках і тестується на наступному
+    order = np.argsort(df[datetime_column].to_numpy(), kind='stable')
+    sorted_datetimes = df[datetime_column].to_numpy()[order]
+    boundaries = block_boundaries(sorted_datetimes, 0, n_splits + 1)
+    return temporal_splits(order, sorted_datetimes, boundaries[1:])
+
+
+def leave_last_n_split(df, datetime_column, n=1, user_column='user_id'):
+    # для кожного користувача останні n оцінок ідуть у test;
+    # користувачі, в яких не більше n оцінок, повністю лишаються в train
+    users = df[user_column].to_numpy()
+    order = np.lexsort((df[datetime_column].to_numpy(), users))
+    _, first_positions, counts = np.unique(users[order], return_index=True, return_counts=True)
+    group_ends = np.repeat(first_positions + counts, counts)
+    from_end = group_ends - np.arange(len(order))
+    test = (from_end <= n) & (np.repeat(counts, counts) > n)
+    return np.sort(order[~test]), np.sort(order[test])
@@ -0,0 +1,149 @@
+import atexit
+import threading
+from collections import OrderedDict
+from datetime import date
+
+from db import PLACEHOLDER
+from instrumentation import stage_timer
+
+# рядків в одному запиті: до 4 параметрів на рядок - в межах ліміту 999 параметрів sqlite
+ROWS_PER_STATEMENT = 200
+
+
+def values_list(rows_count, columns_count):
+    row = '(' + ', '.join([PLACEHOLDER] * columns_count) + ')'
+    return ', '.join([row] * rows_count)
+
+
+def merge_wishlist_change(wishlist, key, change):
+    # зміна списку бажань для (user, item) - (чи видалити наявні рядки, новий рядок або None);
+    # видалення скасовує попереднє додавання, додавання після видалення виконується вже після нього
+    delete_first, row = change
+    if not delete_first and key in wishlist:
+        delete_first = wishlist[key][0]
+    wishlist[key] = (delete_first, row)
+
+
+class WriteBuffer:
+    # write-behind для оцінок і списку бажань: зміни накопичуються в пам'яті й пишуться пачками
+    # (багаторядкові параметризовані запити, один commit) раз на flush_interval секунд
+    # або щойно назбирається max_size змін; при зупинці процесу залишок записується.
+    # Запити не чекають на запис: сторінки користувача додають до прочитаного з БД його незаписані зміни
+    # з буфера цього воркера (pending_ratings, pending_wishlist), а інші воркери gunicorn бачать їх
+    # у БД щонайпізніше через flush_interval секунд; щоб і цього вікна не було, проксі має закріплювати
+    # користувача (uid у сесії) за одним воркером
+    def __init__(self, get_connection, max_size=500, flush_interval=1.0):
+        self.get_connection = get_connection
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self._ratings = []
+        self._wishlist = OrderedDict()
+        # зміни, які саме зараз пишуться: поки commit не завершився, читання їх теж має бачити
+        self._writing = ([], OrderedDict())
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def add_rating(self, user, item, rating, timestamp):
+        with self._lock:
+            self._ratings.append((user, item, rating, timestamp))
+        self._changed()
+
+    def add_to_wishlist(self, user, item, from_recommendations, added_on=None):
+        with self._lock:
+            merge_wishlist_change(self._wishlist, (user, item),
+                                  (False, (user, item, added_on or date.today(), from_recommendations)))
+        self._changed()
+
+    def remove_from_wishlist(self, user, item):
+        with self._lock:
+            merge_wishlist_change(self._wishlist, (user, item), (True, None))
+        self._changed()
+
+    def pending(self):
+        return len(self._ratings) + len(self._wishlist)
+
+    def pending_ratings(self, user):
+        # ще не записані в БД оцінки користувача: (item, rating, timestamp)
+        with self._lock:
+            return [row[1:] for row in self._writing[0] + self._ratings if row[0] == user]
+
+    def pending_wishlist(self, user):
+        # ще не записані зміни списку бажань користувача: item -> (чи видалити наявні рядки, новий рядок або None)
+        with self._lock:
+            wishlist = OrderedDict()
+            for changes in (self._writing[1], self._wishlist):
+                for (change_user, item), change in changes.items():
+                    if change_user == user:
+                        merge_wishlist_change(wishlist, item, change)
+            return wishlist
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                ratings, self._ratings = self._ratings, []
+                wishlist, self._wishlist = self._wishlist, OrderedDict()
+                self._writing = (ratings, wishlist)
+            if not ratings and not wishlist:
+                return 0
+            try:
+                with stage_timer('write_buffer_flush'):
+                    self._write(ratings, wishlist)
+            except Exception:
+                # не записані зміни повертаються в буфер перед тими, що надійшли під час запису
+                with self._lock:
+                    self._ratings = ratings + self._ratings
+                    for key, change in self._wishlist.items():
+                        merge_wishlist_change(wishlist, key, change)
+                    self._wishlist = wishlist
+                    self._writing = ([], OrderedDict())
+                raise
+            with self._lock:
+                self._writing = ([], OrderedDict())
+            return len(ratings) + len(wishlist)
+
+    def _write(self, ratings, wishlist):
+        deleted = [key for key, (delete_first, _) in wishlist.items() if delete_first]
+        added = [row for _, row in wishlist.values() if row is not None]
+        conn = self.get_connection()
+        cur = conn.cursor()
+        try:
+            for start in range(0, len(deleted), ROWS_PER_STATEMENT):
+                chunk = deleted[start:start + ROWS_PER_STATEMENT]
+                cur.execute(f'DELETE FROM wishlist WHERE (user_id, item_id) IN (VALUES {values_list(len(chunk), 2)})',
+                            [value for key in chunk for value in key])
+            for start in range(0, len(added), ROWS_PER_STATEMENT):
+                chunk = added[start:start + ROWS_PER_STATEMENT]
+                cur.execute(f'INSERT INTO wishlist (user_id, item_id, datetime, from_recommendations) '
+                            f'VALUES {values_list(len(chunk), 4)}', [value for row in chunk for value in row])
+            for start in range(0, len(ratings), ROWS_PER_STATEMENT):
+                chunk = ratings[start:start + ROWS_PER_STATEMENT]
+                cur.execute(f'INSERT INTO ratings (user_id, item_id, rating, timestamp) '
+                            f'VALUES {values_list(len(chunk), 4)}', [value for row in chunk for value in row])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+            conn.close()
+
+    def _changed(self):
+        if self.pending() >= self.max_size:
+            self._wakeup.set()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='write-buffer', daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print('write buffer flush failed:', e)